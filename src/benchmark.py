@@ -0,0 +1,142 @@
+import json
+import resource
+import subprocess
+import sys
+import time
+from itertools import product
+from optparse import OptionParser
+
+import numpy as np
+
+MODELS = ("reference", "fixed", "adaptive")
+
+
+def sweep(models, dims, ranks, batch_sizes, threads, steps, inference_steps, output_file):
+    '''
+    runs every configuration in its own process, so that the thread count can be set before tensorflow starts and
+    the peak memory is measured per configuration. The ranks are not swept for the dense reference, and ranks larger
+    than the layer width are skipped.
+    :return: list of results, see run_config
+    '''
+    results = []
+    for model, dim, rank, batch_size, n_threads in product(models, dims, ranks, batch_sizes, threads):
+        if model == "reference" and rank != ranks[0] or model != "reference" and rank > dim:
+            continue
+        config = {"model": model, "dim": dim, "rank": rank if model != "reference" else None,
+                  "batch_size": batch_size, "threads": n_threads, "steps": steps,
+                  "inference_steps": inference_steps}
+        print("benchmark: " + json.dumps(config))
+        process = subprocess.run([sys.executable, __file__, "-c", json.dumps(config)], capture_output=True, text=True)
+        if process.returncode != 0:
+            result = dict(config, error=process.stderr.strip().splitlines()[-1:])
+        else:
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+        print(json.dumps(result))
+        results.append(result)
+        # written after every configuration, so an interrupted sweep keeps its results
+        with open(output_file, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def run_config(config):
+    '''
+    trains and evaluates one network on synthetic MNIST shaped data (784 inputs, 10 classes, 4 hidden layers)
+    :param config: dict with model ("reference", "fixed" or "adaptive"), dim (width of the hidden layers), rank
+                   (starting rank of the low-rank layers), batch_size, threads (intra and inter op threads), steps
+                   (timed training steps) and inference_steps (timed forward passes)
+    :return: config with train_steps_per_s, train_samples_per_s, inference_samples_per_s, peak_rss_mb,
+             inference_params, train_flops_per_step and inference_flops_per_sample
+    '''
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(config["threads"])
+    tf.config.threading.set_inter_op_parallelism_threads(config["threads"])
+    from dlranet import DLRANet, DLRANetAdaptive, ReferenceNet
+
+    input_dim, output_dim, batch_size = 784, 10, config["batch_size"]
+    rng = np.random.default_rng(0)
+    x = tf.constant(rng.random((batch_size, input_dim), dtype=np.float32))
+    y = tf.constant(rng.integers(0, output_dim, batch_size))
+    optimizer = tf.keras.optimizers.Adam(learning_rate=1e-3)
+
+    if config["model"] == "reference":
+        model = ReferenceNet(input_dim=input_dim, output_dim=output_dim, layer_dim=config["dim"])
+
+        @tf.function
+        def train_step(x, y, optimizer):
+            with tf.GradientTape() as tape:
+                out = tf.keras.activations.softmax(model(x, training=True))
+                loss = tf.reduce_mean(tf.keras.losses.sparse_categorical_crossentropy(y, out))
+            optimizer.apply_gradients(zip(tape.gradient(loss, model.trainable_weights), model.trainable_weights))
+            return loss, out
+    else:
+        if config["model"] == "fixed":
+            model = DLRANet(input_dim=input_dim, output_dim=output_dim, low_rank=config["rank"],
+                            dlra_layer_dim=config["dim"], rmax_total=config["rank"])
+            model.build_model()
+        else:
+            # tolerance 0: the ranks stay at the starting rank, so the configurations stay comparable
+            model = DLRANetAdaptive(input_dim=input_dim, output_dim=output_dim, low_rank=config["rank"],
+                                    dlra_layer_dim=config["dim"], tol=0.0, rmax_total=config["rank"])
+        train_step = model.train_step
+
+    # warm up: tracing and first allocation
+    for _ in range(2):
+        loss, _ = train_step(x, y, optimizer)
+    float(loss)
+    start = time.perf_counter()
+    for _ in range(config["steps"]):
+        loss, _ = train_step(x, y, optimizer)
+    float(loss)
+    train_time = time.perf_counter() - start
+
+    if config["model"] == "reference":
+        inference_model = model
+        kernels = [layer.w for layer in (model.layer1, model.layer2, model.layer3, model.layer4, model.layer5)]
+        train_flops = 3 * 2 * batch_size * sum(int(np.prod(w.shape)) for w in kernels)
+    else:
+        inference_model = model.to_inference_model()
+        kernels = [layer.kernel for layer in inference_model.layers]
+        train_flops = sum(model.flops(batch_size, adapt=(config["model"] == "adaptive")).values())
+    forward = tf.function(lambda inputs: inference_model(inputs, training=False))
+    forward(x).numpy()
+    start = time.perf_counter()
+    for _ in range(config["inference_steps"]):
+        out = forward(x)
+    out.numpy()
+    inference_time = time.perf_counter() - start
+
+    return dict(config,
+                train_steps_per_s=config["steps"] / train_time,
+                train_samples_per_s=config["steps"] * batch_size / train_time,
+                inference_samples_per_s=config["inference_steps"] * batch_size / inference_time,
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                inference_params=int(sum(np.prod(v.shape) for v in inference_model.trainable_weights)),
+                train_flops_per_step=int(train_flops),
+                inference_flops_per_sample=2 * sum(int(np.prod(w.shape)) for w in kernels))
+
+
+def int_list(option: str):
+    return [int(value) for value in option.split(",")]
+
+
+if __name__ == '__main__':
+    # --- parse options ---
+    parser = OptionParser()
+    parser.add_option("-m", "--models", dest="models", default=",".join(MODELS))
+    parser.add_option("-d", "--dims", dest="dims", default="256,512")
+    parser.add_option("-r", "--ranks", dest="ranks", default="10,20,50,100")
+    parser.add_option("-b", "--batch_sizes", dest="batch_sizes", default="64,256")
+    parser.add_option("-t", "--threads", dest="threads", default="1,4")
+    parser.add_option("-s", "--steps", dest="steps", default=50)
+    parser.add_option("-i", "--inference_steps", dest="inference_steps", default=200)
+    parser.add_option("-o", "--output", dest="output", default="benchmark.json")
+    parser.add_option("-c", "--config", dest="config", default=None)  # internal: run a single configuration
+
+    (options, args) = parser.parse_args()
+    if options.config is not None:
+        print(json.dumps(run_config(json.loads(options.config))))
+    else:
+        sweep(models=options.models.split(","), dims=int_list(options.dims), ranks=int_list(options.ranks),
+              batch_sizes=int_list(options.batch_sizes), threads=int_list(options.threads),
+              steps=int(options.steps), inference_steps=int(options.inference_steps), output_file=options.output)
@@ -0,0 +1,165 @@
+import json
+import queue
+import threading
+from os import path, fsync, replace, listdir, link, remove
+import numpy as np
+
+CHECKPOINT_FILE = "checkpoint.dlra"
+MAGIC = b"DLRACKPT"
+ALIGNMENT = 64  # byte alignment of every array in the file
+
+
+def write_checkpoint(file_name: str, arrays: dict, metadata=None, keep_last=1):
+    '''
+    writes all arrays into a single file:  magic | header length (uint64) | json header | arrays.
+    The header records dtype, shape and offset of every array (relative to the aligned start of the data section)
+    and the metadata, e.g. the ranks of the layers. The file is written to a temporary file and renamed afterwards,
+    so an interrupted save never leaves a half-written checkpoint behind.
+    :param file_name: checkpoint file
+    :param arrays: dict name -> numpy array (or tensor)
+    :param metadata: json serializable dict
+    :param keep_last: number of checkpoints to keep, the older ones are kept as file_name.1, file_name.2, ...
+    :return: 0
+    '''
+    arrays = {name: np.asarray(value) for name, value in arrays.items()}
+    entries = {}
+    offset = 0
+    for name, value in arrays.items():
+        entries[name] = {"dtype": value.dtype.str, "shape": list(value.shape), "offset": offset}
+        offset = align(offset + value.nbytes)
+    header = json.dumps({"arrays": entries, "metadata": metadata or {}}).encode("utf-8")
+    data_start = align(len(MAGIC) + 8 + len(header))
+
+    tmp_name = file_name + ".tmp"
+    with open(tmp_name, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, value in arrays.items():
+            f.write(b"\0" * (data_start + entries[name]["offset"] - f.tell()))
+            np.ascontiguousarray(value).tofile(f)
+        f.flush()
+        fsync(f.fileno())
+    rotate(file_name, keep_last)
+    replace(tmp_name, file_name)
+    return 0
+
+
+def rotate(file_name: str, keep_last: int):
+    '''
+    shifts file_name.1, file_name.2, ... by one and hard links file_name to file_name.1, so file_name stays valid until
+    it is replaced by the next checkpoint. Only keep_last - 1 old files are kept.
+    '''
+    if keep_last <= 1 or not path.isfile(file_name):
+        return 0
+    for i in range(keep_last - 1, 1, -1):
+        if path.isfile(file_name + "." + str(i - 1)):
+            replace(file_name + "." + str(i - 1), file_name + "." + str(i))
+    if path.isfile(file_name + ".1"):
+        remove(file_name + ".1")
+    link(file_name, file_name + ".1")
+    return 0
+
+
+def read_checkpoint(file_name: str, mmap=True):
+    '''
+    :param file_name: checkpoint file written by write_checkpoint
+    :param mmap: if true, the arrays are read-only views of a memory map of the file and are only read on access
+    :return: dict name -> numpy array, metadata
+    '''
+    with open(file_name, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(file_name + " is not a DLRA checkpoint")
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = align(len(MAGIC) + 8 + header_len)
+
+    if mmap:
+        buffer = np.memmap(file_name, dtype=np.uint8, mode="r")
+    else:
+        buffer = np.fromfile(file_name, dtype=np.uint8)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                     offset=data_start + entry["offset"]).reshape(entry["shape"])
+    return arrays, header["metadata"]
+
+
+def load_arrays(folder_name: str):
+    '''
+    :param folder_name: model folder, containing either a single checkpoint file or one .npy file per array
+    :return: dict name -> numpy array
+    '''
+    file_name = path.join(folder_name, CHECKPOINT_FILE)
+    if path.isfile(file_name):
+        arrays, _ = read_checkpoint(file_name)
+        return arrays
+    return {f[:-len(".npy")]: np.load(path.join(folder_name, f), mmap_mode="r") for f in listdir(folder_name) if
+            f.endswith(".npy")}
+
+
+class CheckpointWriter:
+    '''
+    writes checkpoints in a background thread. write() only queues the arrays and returns, an optional transform of
+    the arrays, the conversion to numpy and the file i/o happen on the writer thread. If max_pending checkpoints are
+    still waiting, write() blocks until one of them is written. Errors of the writer thread are raised by the next
+    call of write(), join() or close().
+    '''
+
+    def __init__(self, max_pending=2, keep_last=1):
+        self.keep_last = keep_last
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="checkpoint_writer", daemon=True)
+        self.thread.start()
+
+    def write(self, file_name: str, arrays: dict, metadata=None, transform=None):
+        '''
+        :param file_name: checkpoint file
+        :param arrays: dict name -> tensor, which must not change afterwards (e.g. values read from variables)
+        :param metadata: json serializable dict
+        :param transform: optional function dict -> dict, applied to the arrays on the writer thread
+        '''
+        self.raise_error()
+        self.pending.put((file_name, arrays, metadata, transform))
+        return 0
+
+    def join(self):
+        '''
+        waits until all queued checkpoints are written
+        '''
+        self.pending.join()
+        self.raise_error()
+        return 0
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self.raise_error()
+        return 0
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            file_name, arrays, metadata, transform = item
+            try:
+                if transform is not None:
+                    arrays = transform(arrays)
+                write_checkpoint(file_name, arrays, metadata, keep_last=self.keep_last)
+            except Exception as e:
+                self.error = e
+            self.pending.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def align(n_bytes: int):
+    return -(-n_bytes // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,136 @@
+import tensorflow as tf
+from tensorflow import keras
+from os import path, makedirs
+import numpy as np
+
+AUTOTUNE = tf.data.AUTOTUNE
+SHARD_PATTERN = "shard-*.tfrecord"
+
+
+def load_mnist(val_size=10000):
+    '''
+    :param val_size: number of training samples reserved for validation (the last ones)
+    :return: (x_train, y_train), (x_val, y_val), (x_test, y_test), images flattened to 784 pixels, still uint8
+    '''
+    (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
+    x_train = np.reshape(x_train, (x_train.shape[0], -1))
+    x_test = np.reshape(x_test, (x_test.shape[0], -1))
+    return (x_train[:-val_size], y_train[:-val_size]), (x_train[-val_size:], y_train[-val_size:]), (x_test, y_test)
+
+
+def mnist_datasets(batch_size, val_size=10000, seed=None, deterministic=False):
+    '''
+    builds the pipelines of the scripts. Validation and test set are not shuffled, their normalized batches are cached
+    after the first evaluation.
+    :param batch_size: batch size of all three datasets
+    :param seed: shuffle seed, see make_dataset
+    :param deterministic: see make_dataset
+    :return: train_dataset, val_dataset, test_dataset
+    '''
+    (x_train, y_train), (x_val, y_val), (x_test, y_test) = load_mnist(val_size=val_size)
+    train_dataset = make_dataset(x_train, y_train, batch_size=batch_size, seed=seed, deterministic=deterministic)
+    val_dataset = make_dataset(x_val, y_val, batch_size=batch_size, shuffle=False, deterministic=deterministic,
+                               cache=True)
+    test_dataset = make_dataset(x_test, y_test, batch_size=batch_size, shuffle=False, deterministic=deterministic,
+                                cache=True)
+    return train_dataset, val_dataset, test_dataset
+
+
+def make_dataset(x, y, batch_size, shuffle=True, shuffle_buffer=None, seed=None, deterministic=False,
+                 cache=False):
+    '''
+    in memory pipeline: shuffle | batch | normalize | prefetch. The samples stay uint8 until a batch is normalized,
+    which is a single vectorized op per batch that runs in parallel to the training step.
+    :param x: images (samples x pixels), uint8
+    :param y: labels
+    :param shuffle: reshuffle the samples in every epoch
+    :param shuffle_buffer: shuffle window, default: the whole dataset
+    :param seed: shuffle seed. With a seed and deterministic=True, every run sees the same batches
+    :param deterministic: keep the order of the parallel map. False lets tf.data return batches as soon as they are
+                          ready
+    :param cache: cache the normalized batches in memory after the first epoch (only useful without shuffle)
+    :return: tf.data.Dataset of (images, labels) batches, images as float32 in [0, 1]
+    '''
+    dataset = tf.data.Dataset.from_tensor_slices((x, y))
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer or len(x), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(normalize_img, num_parallel_calls=AUTOTUNE)
+    if cache:
+        dataset = dataset.cache()
+    return finalize(dataset, deterministic)
+
+
+def write_shards(x, y, folder_name: str, num_shards=8):
+    '''
+    writes a dataset as TFRecord shards, which sharded_dataset streams without loading them into memory
+    :param x: images (samples x pixels), uint8
+    :param y: labels
+    :param folder_name: output folder, the files are named shard-00000-of-00008.tfrecord, ...
+    :param num_shards: number of files
+    :return: list of the written files
+    '''
+    if not path.exists(folder_name):
+        makedirs(folder_name)
+    file_names = []
+    for shard, indices in enumerate(np.array_split(np.arange(len(x)), num_shards)):
+        file_name = path.join(folder_name, "shard-%05d-of-%05d.tfrecord" % (shard, num_shards))
+        with tf.io.TFRecordWriter(file_name) as writer:
+            for i in indices:
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[x[i].astype(np.uint8).tobytes()])),
+                    "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(y[i])]))}))
+                writer.write(example.SerializeToString())
+        file_names.append(file_name)
+    return file_names
+
+
+def sharded_dataset(folder_name: str, batch_size, input_dim=784, shuffle=True, shuffle_buffer=10000, seed=None,
+                    deterministic=False, cache_file=None, cycle_length=4):
+    '''
+    streaming pipeline for datasets larger than memory: the shards written by write_shards are read in parallel
+    and interleaved, shuffled in a window of shuffle_buffer samples, parsed and normalized per batch and prefetched.
+    :param folder_name: folder with the shards
+    :param input_dim: number of pixels per image
+    :param shuffle: shuffle the order of the shards and the samples in every epoch
+    :param shuffle_buffer: shuffle window in samples
+    :param seed: shuffle seed, see make_dataset
+    :param deterministic: see make_dataset. Also fixes the interleave order of the shards
+    :param cache_file: if set, the parsed batches of the first epoch are cached in this file (only useful without
+                       shuffle)
+    :param cycle_length: number of shards read at the same time
+    :return: tf.data.Dataset of (images, labels) batches, images as float32 in [0, 1]
+    '''
+    files = tf.data.Dataset.list_files(path.join(folder_name, SHARD_PATTERN), shuffle=shuffle, seed=seed)
+    dataset = files.interleave(tf.data.TFRecordDataset, cycle_length=cycle_length, num_parallel_calls=AUTOTUNE,
+                               deterministic=deterministic)
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda records: normalize_img(*parse_examples(records, input_dim)),
+                          num_parallel_calls=AUTOTUNE)
+    if cache_file is not None:
+        dataset = dataset.cache(cache_file)
+    return finalize(dataset, deterministic)
+
+
+def parse_examples(records, input_dim):
+    '''
+    :param records: batch of serialized examples written by write_shards
+    :return: images (batch x input_dim) as uint8, labels
+    '''
+    features = tf.io.parse_example(records, {"image": tf.io.FixedLenFeature([], tf.string),
+                                             "label": tf.io.FixedLenFeature([], tf.int64)})
+    images = tf.reshape(tf.io.decode_raw(features["image"], tf.uint8), (-1, input_dim))
+    return images, features["label"]
+
+
+def finalize(dataset, deterministic):
+    options = tf.data.Options()
+    options.deterministic = deterministic
+    return dataset.with_options(options).prefetch(AUTOTUNE)
+
+
+def normalize_img(image, label):
+    """Normalizes images: `uint8` -> `float32`."""
+    return tf.cast(image, tf.float32) / 255., label
@@ -0,0 +1,140 @@
+import tensorflow as tf
+
+# slots that accumulate squared gradients. They are projected with the elementwise squared transforms, which keeps
+# them non negative. This is a heuristic: it is exact for permutations and sign flips of the basis, but for a general
+# rotation the second moments of the new coordinates depend on the correlations of the old ones, which are not
+# stored. All other slots (first moments, momentum) are linear in the gradients and are projected exactly, like the
+# variable itself.
+SECOND_MOMENT_SLOTS = ("v", "vhat", "rms", "accumulator", "accum_grad", "accum_var")
+
+
+class DLRAOptimizer(tf.Module):
+    '''
+    optimizer for the DLRA networks with separate state for the K-, L- and S-step. The gradients of each sub step
+    are applied by an own optimizer, so each one keeps moments for its factors only.
+
+    The factors K, L and S are coordinates in the current bases U and V, which the integrator rotates in every step
+    (and truncates in the rank adaption). The network calls project() with these transformations, so that the
+    moments stay aligned with the factors they belong to, see DLRALayer.project_optimizer_state. Projection needs
+    optimizers with the get_slot API (tf.keras.optimizers of TF < 2.11 or tf.keras.optimizers.legacy). The state of
+    other optimizers is kept as it is.
+
+    The three optimizers are tracked, so the wrapper can be saved with tf.train.Checkpoint. It is not a keras
+    LossScaleOptimizer, mixed_float16 training needs a single optimizer for all sub steps.
+    '''
+
+    def __init__(self, model, optimizer, l_optimizer=None, s_optimizer=None):
+        '''
+        :param model: DLRANet or DLRANetAdaptive, which decides which variables are K, L or S factors
+        :param optimizer: optimizer of the K-step. Also for the L- and S-step, with separate state (a copy of its
+                          configuration), if l_optimizer or s_optimizer are not given
+        :param s_optimizer: optimizer of S, the biases and the output layer
+        '''
+        super(DLRAOptimizer, self).__init__(name="dlra_optimizer")
+        self.model = model
+        self.k_optimizer = optimizer
+        self.l_optimizer = l_optimizer if l_optimizer is not None else copy_optimizer(optimizer)
+        self.s_optimizer = s_optimizer if s_optimizer is not None else copy_optimizer(optimizer)
+        self.built = False
+
+    @property
+    def iterations(self):
+        '''
+        :return: number of training steps, every step applies the gradients of each optimizer once
+        '''
+        return self.s_optimizer.iterations
+
+    @property
+    def learning_rate(self):
+        return self.k_optimizer.learning_rate
+
+    @learning_rate.setter
+    def learning_rate(self, learning_rate):
+        for optimizer in (self.k_optimizer, self.l_optimizer, self.s_optimizer):
+            optimizer.learning_rate = learning_rate
+
+    def optimizer_of(self, variable):
+        '''
+        :return: the optimizer that trains variable
+        '''
+        for layer in self.model.dlra_layers:
+            if variable is layer.k:
+                return self.k_optimizer
+            if variable is layer.l_t:
+                return self.l_optimizer
+        return self.s_optimizer
+
+    def split(self, grads_and_vars):
+        '''
+        :return: list of (optimizer, list of its (gradient, variable) pairs)
+        '''
+        groups = {}
+        for grad, variable in grads_and_vars:
+            optimizer = self.optimizer_of(variable)
+            groups.setdefault(id(optimizer), (optimizer, []))[1].append((grad, variable))
+        return list(groups.values())
+
+    def build(self, variables):
+        '''
+        creates the slots of all variables before the first step, so that project() finds them already while the
+        train step is traced. Only the first call builds the optimizers.
+        :param variables: all variables trained by the optimizer
+        '''
+        if self.built:
+            return 0
+        for optimizer, group in self.split([(None, variable) for variable in variables]):
+            group = [variable for _, variable in group]
+            if hasattr(optimizer, "build"):
+                optimizer.build(group)
+            else:
+                with tf.init_scope():
+                    optimizer._create_all_weights(group)
+        self.built = True
+        return 0
+
+    def apply_gradients(self, grads_and_vars):
+        for optimizer, group in self.split(grads_and_vars):
+            optimizer.apply_gradients(group)
+        return 0
+
+    def get_slot(self, variable, slot_name):
+        return self.optimizer_of(variable).get_slot(variable, slot_name)
+
+    def slot_names(self, variable):
+        '''
+        :return: names of the slots of variable, empty if its optimizer has no get_slot API
+        '''
+        optimizer = self.optimizer_of(variable)
+        if not hasattr(optimizer, "get_slot_names"):
+            return []
+        return optimizer.get_slot_names()
+
+    def project(self, variable, left=None, right=None):
+        '''
+        transforms the slots of a factor X of shape (rows x cols) to the new bases: X -> left X right^T. The slots
+        of the adaptive layers are padded, only their leading block (left.shape[1] x right.shape[1]) is transformed
+        and the result is written back padded with zeros.
+        :param variable: k, l_t or s of a low-rank layer
+        :param left: transformation of the rows (new rows x old rows), None keeps the rows
+        :param right: transformation of the columns (new cols x old cols), None keeps the columns
+        '''
+        for slot_name in self.slot_names(variable):
+            slot = self.get_slot(variable, slot_name)
+            rows = slot.shape[0] if left is None else tf.shape(left)[1]
+            cols = slot.shape[1] if right is None else tf.shape(right)[1]
+            value = slot[:rows, :cols]
+            second_moment = slot_name in SECOND_MOMENT_SLOTS
+            if left is not None:
+                value = tf.matmul(tf.square(left) if second_moment else left, value)
+            if right is not None:
+                value = tf.matmul(value, tf.square(right) if second_moment else right, transpose_b=True)
+            slot.assign(tf.pad(value, [[0, slot.shape[0] - tf.shape(value)[0]],
+                                       [0, slot.shape[1] - tf.shape(value)[1]]]))
+        return 0
+
+
+def copy_optimizer(optimizer):
+    '''
+    :return: new optimizer with the configuration of optimizer and empty state
+    '''
+    return optimizer.__class__.from_config(optimizer.get_config())
@@ -1,219 +1,668 @@
 import tensorflow as tf
 from tensorflow import keras
 from os import path, makedirs
+from functools import lru_cache
 import numpy as np
 
+from checkpoint import write_checkpoint, load_arrays, CHECKPOINT_FILE
+from profiling import phase
+from dlra_optimizer import DLRAOptimizer
 
-class DLRANet(keras.Model):
 
-    def __init__(self, input_dim=1, output_dim=1, name="e2eDLRANet", tol=0.4, low_rank=20, dlra_layer_dim=200,
-                 rmax_total=100, **kwargs):
-        super(DLRANet, self).__init__(name=name, **kwargs)
-        # dlra_layer_dim = 250
-        self.input_dim = input_dim
-        self.dlra_layer_dim = dlra_layer_dim
-        self.low_rank = low_rank
-        self.output_dim = output_dim
-        self.tol = tol
-        self.rmax_total = rmax_total
+class DLRANetBase(keras.Model):
+    """
+    evaluation, training steps and checkpoints shared by DLRANet and DLRANetAdaptive. The subclasses create
+    dlra_layers and dlraBlockOutput and implement the parts of the integrator that depend on the rank: the
+    postprocessing, _train_step, _distributed_train_step, project_optimizer_state and ranks.
+    """
 
-        self.dlraBlockInput = DLRALayer(input_dim=self.input_dim, units=self.dlra_layer_dim, low_rank=self.low_rank,
-                                        epsAdapt=self.tol, rmax_total=self.rmax_total, )
-        self.dlraBlock1 = DLRALayer(input_dim=self.dlra_layer_dim, units=self.dlra_layer_dim, low_rank=self.low_rank,
-                                    epsAdapt=self.tol,
-                                    rmax_total=self.rmax_total, )
-        self.dlraBlock2 = DLRALayer(input_dim=self.dlra_layer_dim, units=self.dlra_layer_dim, low_rank=self.low_rank,
-                                    epsAdapt=self.tol,
-                                    rmax_total=self.rmax_total, )
-        self.dlraBlock3 = DLRALayer(input_dim=self.dlra_layer_dim, units=self.dlra_layer_dim, low_rank=self.low_rank,
-                                    epsAdapt=self.tol,
-                                    rmax_total=rmax_total, )
-        self.dlraBlockOutput = Linear2(input_dim=self.dlra_layer_dim, units=self.output_dim)
+    def __init__(self, name="e2eDLRANet", **kwargs):
+        super(DLRANetBase, self).__init__(name=name, **kwargs)
+        # metrics of evaluate(), accumulated in the graph over all batches
+        self.eval_loss_metric = tf.keras.metrics.Mean(name="eval_loss")
+        self.eval_acc_metric = tf.keras.metrics.SparseCategoricalAccuracy(name="eval_accuracy")
+        # metrics of the S-step of train_step, accumulated in the graph until reset_train_metrics()
+        self.train_loss_metric = tf.keras.metrics.Mean(name="train_loss")
+        self.train_acc_metric = tf.keras.metrics.SparseCategoricalAccuracy(name="train_accuracy")
 
-    def build_model(self):
-        self.dlraBlockInput.build_model()
-        self.dlraBlock1.build_model()
-        self.dlraBlock2.build_model()
-        self.dlraBlock3.build_model()
+    @tf.function
+    def call(self, inputs, step: int = 0, products=None):
+        """
+        :param inputs: network input
+        :param step: step conter: k:= 0, l:=1, s:=2, fused k and l:=3
+        :param products: pre-multiplied factors of the k-step of all layers from forward_products, or None
+        :return: for step 3, the outputs of the k- and l-network stacked along the first axis
+        """
+        z = inputs
+        for i, layer in enumerate(self.dlra_layers):
+            z = layer(z, step=step, products=None if products is None else products[i])
+        z = self.dlraBlockOutput(z)
+        # softmax and loss in float32, also under a mixed precision policy
+        return tf.cast(z, tf.float32)
+
+    # integrator sub steps of all low-rank layers, each as one graph call
+    @tf.function
+    def k_step_preprocessing(self):
+        for layer in self.dlra_layers:
+            layer.k_step_preprocessing()
         return 0
 
     @tf.function
-    def call(self, inputs, step: int = 0):
-        z = self.dlraBlockInput(inputs, step=step)
-        z = self.dlraBlock1(z, step=step)
-        z = self.dlraBlock2(z, step=step)
-        z = self.dlraBlock3(z, step=step)
-        z = self.dlraBlockOutput(z)
-        return z
+    def l_step_preprocessing(self):
+        for layer in self.dlra_layers:
+            layer.l_step_preprocessing()
+        return 0
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
+    @tf.function
+    def s_step_preprocessing(self):
+        for layer in self.dlra_layers:
+            layer.s_step_preprocessing()
+        return 0
+
+    def evaluate(self, dataset, batch_size=256):
+        """
+        streams a dataset through the network in batches (K-step forward pass) and accumulates the loss and the
+        accuracy of all samples in the graph. Validation and test set share one compiled evaluation function.
+        :param dataset: tf.data.Dataset of (x, y) batches, or a tuple (x, y) of arrays, which is split into batches
+        :param batch_size: batch size, if dataset is a tuple
+        :return: mean loss and accuracy over all samples
+        """
+        if not isinstance(dataset, tf.data.Dataset):
+            dataset = tf.data.Dataset.from_tensor_slices(dataset).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+        # the batches are split over the replicas, if the model was created in a tf.distribute strategy scope
+        dataset = self.distribute_strategy.experimental_distribute_dataset(dataset)
+        self.k_step_preprocessing()
+        self.eval_loss_metric.reset_state()
+        self.eval_acc_metric.reset_state()
+        self.evaluate_batches(dataset)
+        return float(self.eval_loss_metric.result()), float(self.eval_acc_metric.result())
+
+    @tf.function
+    def evaluate_batches(self, dataset):
+        # the factors do not change during the evaluation, so their products are computed once for all batches
+        products = self.forward_products()
+        for x, y in dataset:
+            self.distribute_strategy.run(self.evaluate_batch, args=(x, y, products))
+        return 0
+
+    def evaluate_batch(self, x, y, products):
+        out = tf.keras.activations.softmax(self(x, step=0, training=False, products=products))
+        self.eval_loss_metric.update_state(keras.losses.sparse_categorical_crossentropy(y, out))
+        self.eval_acc_metric.update_state(y, out)
+        return 0
+
+    def forward_products(self):
         """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
+        pre-multiplies the factors of the k-step forward pass of all layers, for many forward passes without an update
+        in between, e.g. all batches of evaluate. The products are only valid until the next update of the factors.
+        :return: list with the products of each layer, for call(products=...)
         """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
+        return [layer.forward_products() for layer in self.dlra_layers]
+
+    def train_metrics(self):
+        """
+        reading the metrics waits for the device, so this should only be called at logging intervals
+        :return: mean S-step loss (per sample) and accuracy of all training steps since reset_train_metrics()
+        """
+        return float(self.train_loss_metric.result()), float(self.train_acc_metric.result())
+
+    def reset_train_metrics(self):
+        self.train_loss_metric.reset_state()
+        self.train_acc_metric.reset_state()
         return 0
 
+    def flops(self, batch_size, adapt=False):
+        """
+        :param adapt: count a step with basis augmentation and rank adaption
+        :return: dict phase -> flops of one training step at the current ranks, see step_flops
+        """
+        flops = {}
+        for layer in self.dlra_layers:
+            for name, value in layer.flops(batch_size, adapt=adapt).items():
+                flops[name] = flops.get(name, 0) + value
+        # output layer, in the two branches of the K- and L-tape and in the S-tape
+        dense = 2 * batch_size * self.dlraBlockOutput.w.shape[0] * self.dlraBlockOutput.w.shape[1]
+        flops["kl_tape"] += 3 * 2 * dense
+        flops["s_tape"] += 3 * dense
+        return flops
+
+    def train_step(self, x, y, optimizer):
+        """
+        performs one K-, L- and S-step of the integrator for all layers and, for DLRANetAdaptive, the rank adaption
+        in a single compiled graph
+        :param x: input batch
+        :param y: labels of the batch
+        :param optimizer: optimizer for the K, L and S updates, wrapped in a LossScaleOptimizer for float16
+        :return: loss and softmax output of the S-step
+        """
+        return self._compiled_train_step(x, y, optimizer)
+
+    def profiled_train_step(self, x, y, optimizer, timer):
+        """
+        train_step, with the time of each phase measured by timer. The step is not compiled as a whole, only its sub
+        steps, so that the phases can be timed separately. It is therefore slower than train_step.
+        :param timer: profiling.PhaseTimer
+        :return: loss and softmax output of the S-step
+        """
+        loss, out = self._train_step(x, y, optimizer, timer=timer)
+        timer.count_step()
+        return loss, out
+
+    def kl_step(self, x, y, optimizer, timer=None):
+        """
+        tapes and applies the gradients of the fused K- and L-step. Runs per replica under a tf.distribute strategy,
+        the optimizer all-reduces the gradients.
+        :return: loss of the K- and L-step
+        """
+        variables = self.kl_step_variables()
+        with phase(timer, "kl_tape") as outputs:
+            with tf.GradientTape(watch_accessed_variables=False) as tape:
+                tape.watch(variables)
+                out = tf.keras.activations.softmax(self(x, step=3, training=True))
+                loss = self.classification_loss(y, out[0]) + self.classification_loss(y, out[1])
+                loss += self.regularization_loss()
+                scaled_loss = get_scaled_loss(optimizer, loss)
+            grads_kl_step = get_unscaled_gradients(optimizer, tape.gradient(scaled_loss, variables))
+            outputs.append(grads_kl_step)
+        with phase(timer, "kl_apply") as outputs:
+            optimizer.apply_gradients(zip(grads_kl_step, variables))
+            outputs.append(variables)
+        return loss
+
+    def s_step(self, x, y, optimizer, timer=None):
+        """
+        tapes and applies the gradients of the S-step and updates the training metrics. Runs per replica under a
+        tf.distribute strategy, the optimizer all-reduces the gradients.
+        :return: loss and softmax output of the S-step
+        """
+        variables = self.s_step_variables()
+        with phase(timer, "s_tape") as outputs:
+            with tf.GradientTape(watch_accessed_variables=False) as tape:
+                tape.watch(variables)
+                out = tf.keras.activations.softmax(self(x, step=2, training=True))
+                loss = self.classification_loss(y, out)
+                loss += self.regularization_loss()
+                scaled_loss = get_scaled_loss(optimizer, loss)
+            grads_s = get_unscaled_gradients(optimizer, tape.gradient(scaled_loss, variables))
+            outputs.append(grads_s)
+        with phase(timer, "s_apply") as outputs:
+            optimizer.apply_gradients(zip(grads_s, variables))
+            outputs.append(variables)
+        self.train_loss_metric.update_state(keras.losses.sparse_categorical_crossentropy(y, out))
+        self.train_acc_metric.update_state(y, out)
+        return loss, out
+
+    def distributed_train_step(self, x, y, optimizer, strategy):
+        """
+        data parallel train_step: the K-, L- and S-steps run on every replica on its part of the batch and the
+        gradients are all-reduced before they are applied. The QR decompositions of the postprocessing (and the rank
+        adaption) run in cross-replica context on the updated, identical variables, so the bases and ranks stay the
+        same on all replicas. The model and the optimizer have to be created in strategy.scope().
+        :param x: distributed input batch, e.g. from strategy.experimental_distribute_dataset
+        :param y: distributed labels of the batch
+        :param strategy: tf.distribute.Strategy
+        :return: loss of the global batch and per replica softmax output of the S-step
+        """
+        return self._compiled_distributed_train_step(x, y, optimizer, strategy)
+
     @staticmethod
-    def set_dlra_bias_grads_to_zero(grads):
+    def classification_loss(y, out):
         """
-        :param grads: gradients of current tape
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
+        :param y: labels
+        :param out: softmax output of the network
+        :return: mean sparse categorical crossentropy, under a tf.distribute strategy scaled to the global batch
         """
-        for i in range(len(grads)):
-            if len(grads[i].shape) == 1:
-                grads[i] = tf.math.scalar_mul(0.0, grads[i])
+        return tf.nn.compute_average_loss(keras.losses.sparse_categorical_crossentropy(y, out))
+
+    def regularization_loss(self):
+        """
+        :return: sum of the layer losses, under a tf.distribute strategy scaled by the number of replicas
+        """
+        if not self.losses:
+            return 0.0
+        return tf.nn.scale_regularization_loss(tf.add_n(self.losses))
+
+    def kl_step_variables(self):
+        """
+        the bias and the output layer are frozen in the K- and L-step, S is not used. They are neither taped nor
+        passed to the optimizer, so the optimizer does not update them (or their moments) with zero gradients.
+        :return: variables trained in the K- and L-step: K and L of all low-rank layers
+        """
+        return [variable for layer in self.dlra_layers for variable in (layer.k, layer.l_t)]
+
+    def s_step_variables(self):
+        """
+        :return: variables trained in the S-step: S and the bias of all low-rank layers and the output layer
+        """
+        return [variable for layer in self.dlra_layers for variable in (layer.s, layer.b)] + [
+            self.dlraBlockOutput.w, self.dlraBlockOutput.b]
+
+    def to_inference_model(self):
+        """
+        freezes the current weights into a plain keras model without the auxiliary training variables. Each low-rank
+        layer becomes either the two matmuls (U S) and Vt or the merged dense W = U S Vt, whichever is cheaper.
+        :return: keras.Sequential that maps inputs to the same output as call()
+        """
+        inference_layers = []
+        for layer in self.dlra_layers:
+            us, vt = layer.inference_factors()
+            inference_layers += low_rank_inference_layers(us, vt, layer.b.numpy(), activation="relu")
+        inference_layers += low_rank_inference_layers(self.dlraBlockOutput.w.numpy(), None,
+                                                      self.dlraBlockOutput.b.numpy())
+        model = keras.Sequential(inference_layers, name=self.name + "_inference")
+        model.build((None, self.dlra_layers[0].input_dim))
+        return model
+
+    def save(self, folder_name, compact=False, writer=None):
+        """
+        writes all layers into a single checkpoint file in folder_name, see checkpoint.write_checkpoint
+        :param compact: if true, only the factors U, S, Vt and the biases are written. load rebuilds the rest.
+        :param writer: optional checkpoint.CheckpointWriter, that writes the file in the background
+        """
+        arrays = {}
+        for layer_id, layer in enumerate(self.dlra_layers):
+            arrays.update(layer.get_arrays(layer_id=layer_id, compact=compact))
+        arrays.update(self.dlraBlockOutput.get_arrays(layer_id=len(self.dlra_layers)))
+        ranks = self.ranks()
+        file_name = path.join(folder_name, CHECKPOINT_FILE)
+        if writer is None:
+            write_checkpoint(file_name, compact_coefficients(arrays) if compact else arrays,
+                             metadata={"ranks": ranks, "compact": compact})
+        else:
+            writer.write(file_name, arrays, metadata={"ranks": ranks, "compact": compact},
+                         transform=compact_coefficients if compact else None)
         return 0
 
-    def toggle_non_s_step_training(self):
-        # self.layers[0].trainable = False  # Dense input
-        self.layers[-1].trainable = False  # Dense output
+    def load(self, folder_name):
+        """
+        loads a checkpoint file written by save, or the per layer .npy files of older checkpoints
+        """
+        arrays = load_arrays(folder_name)
+        for layer_id, layer in enumerate(self.dlra_layers):
+            layer.set_arrays(arrays, layer_id=layer_id)
+        self.dlraBlockOutput.set_arrays(arrays, layer_id=len(self.dlra_layers))
+        return 0
 
+
+class DLRANet(DLRANetBase):
+
+    def __init__(self, input_dim=1, output_dim=1, name="e2eDLRANet", tol=0.4, low_rank=20, dlra_layer_dim=200,
+                 rmax_total=100, jit_compile=False, layer_dims=None, dtype_policy=None, **kwargs):
+        """
+        :param low_rank: rank of all low-rank layers, or a list with one rank per layer
+        :param dlra_layer_dim: width of the low-rank layers, if layer_dims is not given
+        :param layer_dims: list with the width of each low-rank layer, default: 4 layers of width dlra_layer_dim
+        :param jit_compile: compile train_step with XLA
+        :param dtype_policy: keras dtype policy of the layers, e.g. "mixed_bfloat16" or "mixed_float16". The forward
+                             matmuls run in the compute dtype, while the variables, the QR decompositions and the
+                             network output stay in float32. Default: the global policy
+        """
+        super(DLRANet, self).__init__(name=name, **kwargs)
+        # dlra_layer_dim = 250
+        self.input_dim = input_dim
+        self.dlra_layer_dim = dlra_layer_dim
+        self.layer_dims = list(layer_dims) if layer_dims is not None else [dlra_layer_dim] * 4
+        self.low_rank = low_rank if isinstance(low_rank, (list, tuple)) else [low_rank] * len(self.layer_dims)
+        self.output_dim = output_dim
+        self.tol = tol
+        self.rmax_total = rmax_total
+
+        input_dims = [self.input_dim] + self.layer_dims[:-1]
+        self.dlra_layers = [DLRALayer(input_dim=input_dims[i], units=self.layer_dims[i], low_rank=self.low_rank[i],
+                                      epsAdapt=self.tol, rmax_total=self.rmax_total, dtype=dtype_policy)
+                            for i in range(len(self.layer_dims))]
+        self.dlraBlockOutput = Linear2(input_dim=self.layer_dims[-1], units=self.output_dim, dtype=dtype_policy)
+
+        # whole integrator step as one graph, optionally compiled with XLA
+        self._compiled_train_step = tf.function(self._train_step, jit_compile=jit_compile)
+        self._compiled_distributed_train_step = tf.function(self._distributed_train_step)
+
+    def build_model(self):
+        for layer in self.dlra_layers:
+            layer.build_model()
         return 0
 
-    def toggle_s_step_training(self):
-        # self.layers[0].trainable = True  # Dense input
-        self.layers[-1].trainable = True  # Dense output
+    @tf.function
+    def k_step_postprocessing(self):
+        """
+        orthonormalizes the K factors, with one batched QR decomposition per group of equally shaped layers
+        """
+        for layers in group_by_shape(self.dlra_layers):
+            bases = batched_qr([layer.k for layer in layers], [layer.low_rank for layer in layers])
+            for layer, aux_Unp1 in zip(layers, bases):
+                layer.set_k_basis(aux_Unp1)
         return 0
 
-    def save(self, folder_name):
-        self.dlraBlockInput.save(folder_name=folder_name, layer_id=0)
-        self.dlraBlock1.save(folder_name=folder_name, layer_id=1)
-        self.dlraBlock2.save(folder_name=folder_name, layer_id=2)
-        self.dlraBlock3.save(folder_name=folder_name, layer_id=3)
-        self.dlraBlockOutput.save(folder_name=folder_name, layer_id=4)
+    @tf.function
+    def l_step_postprocessing(self):
+        """
+        orthonormalizes the L factors, with one batched QR decomposition per group of equally shaped layers
+        """
+        for layers in group_by_shape(self.dlra_layers):
+            bases = batched_qr([tf.transpose(layer.l_t) for layer in layers], [layer.low_rank for layer in layers])
+            for layer, aux_Vnp1 in zip(layers, bases):
+                layer.set_l_basis(aux_Vnp1)
         return 0
 
-    def load(self, folder_name):
-        self.dlraBlockInput.load(folder_name=folder_name, layer_id=0)
-        self.dlraBlock1.load(folder_name=folder_name, layer_id=1)
-        self.dlraBlock2.load(folder_name=folder_name, layer_id=2)
-        self.dlraBlock3.load(folder_name=folder_name, layer_id=3)
-        self.dlraBlockOutput.load(folder_name=folder_name, layer_id=4)
+    def project_optimizer_state(self, optimizer):
+        """
+        rotates the moments of a DLRAOptimizer into the new bases, see DLRALayer.project_optimizer_state
+        """
+        if isinstance(optimizer, DLRAOptimizer):
+            for layer in self.dlra_layers:
+                layer.project_optimizer_state(optimizer)
         return 0
 
-    def load_from_fullW(self, folder_name, rank):
-        self.dlraBlockInput.load_from_fullW(folder_name=folder_name, layer_id=0, rank=rank)
-        self.dlraBlock1.load_from_fullW(folder_name=folder_name, layer_id=1, rank=rank)
-        self.dlraBlock2.load_from_fullW(folder_name=folder_name, layer_id=2, rank=rank)
-        self.dlraBlock3.load_from_fullW(folder_name=folder_name, layer_id=3, rank=rank)
-        self.dlraBlockOutput.load(folder_name=folder_name, layer_id=4)
+    def ranks(self):
+        """
+        :return: list with the current rank of each low-rank layer
+        """
+        return [int(layer.low_rank) for layer in self.dlra_layers]
+
+    def _train_step(self, x, y, optimizer, timer=None):
+        build_optimizer(optimizer, self.kl_step_variables() + self.s_step_variables())
+        # 1.a) K and L Step Preproccessing
+        with phase(timer, "kl_preprocessing") as outputs:
+            outputs.append(self.k_step_preprocessing())
+            outputs.append(self.l_step_preprocessing())
+
+        # 1.b) Tape and apply Gradients for fused K- and L-Step
+        self.kl_step(x, y, optimizer, timer=timer)
+
+        # 2) Postprocessing K and L, S-Step Preprocessing
+        with phase(timer, "qr_postprocessing") as outputs:
+            outputs.append(self.k_step_postprocessing())
+            outputs.append(self.l_step_postprocessing())
+        with phase(timer, "s_preprocessing") as outputs:
+            outputs.append(self.s_step_preprocessing())
+            self.project_optimizer_state(optimizer)
+            outputs.append(self.s_step_variables())
+
+        # 3) Tape and apply Gradients for S-Step
+        loss, out = self.s_step(x, y, optimizer, timer=timer)
+        return loss, out
+
+    def _distributed_train_step(self, x, y, optimizer, strategy):
+        build_optimizer(optimizer, self.kl_step_variables() + self.s_step_variables())
+        self.k_step_preprocessing()
+        self.l_step_preprocessing()
+        strategy.run(self.kl_step, args=(x, y, optimizer))
+        self.k_step_postprocessing()
+        self.l_step_postprocessing()
+        self.s_step_preprocessing()
+        self.project_optimizer_state(optimizer)
+        loss, out = strategy.run(self.s_step, args=(x, y, optimizer))
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None), out
+
+    def load_from_fullW(self, folder_name, rank, svd="full"):
+        """
+        initializes the low-rank layers with the truncated svd of the dense weights of a ReferenceNet
+        :param svd: "full" or "randomized", see DLRALayer.load_from_fullW
+        """
+        for layer_id, layer in enumerate(self.dlra_layers):
+            layer.load_from_fullW(folder_name=folder_name, layer_id=layer_id, rank=rank, svd=svd)
+        self.dlraBlockOutput.load(folder_name=folder_name, layer_id=len(self.dlra_layers))
         return 0
 
 
-class DLRANetAdaptive(keras.Model):
+class DLRANetAdaptive(DLRANetBase):
 
     def __init__(self, input_dim=1, output_dim=1, name="e2eDLRANet", tol=0.4, low_rank=20, dlra_layer_dim=200,
-                 rmax_total=100, **kwargs):
+                 rmax_total=100, adapt_criterion="relative", adapt_every=1, adapt_trigger=None, layer_dims=None,
+                 dtype_policy=None, rank_budget=None, budget_unit="rank", **kwargs):
+        """
+        :param low_rank: starting rank of all low-rank layers, or a list with one rank per layer
+        :param dlra_layer_dim: width of the low-rank layers, if layer_dims is not given
+        :param adapt_every: truncate the ranks every adapt_every steps (0: only on schedule_rank_adaption())
+        :param adapt_trigger: if set, truncate also once the singular value estimate of any layer changed by more
+                              than this (relative) since its last truncation, see spectrum_drift. Between
+                              truncations, the layers take fixed rank steps.
+        :param layer_dims: list with the width of each low-rank layer, default: 4 layers of width dlra_layer_dim
+        :param dtype_policy: keras dtype policy of the layers, e.g. "mixed_bfloat16" or "mixed_float16". The forward
+                             matmuls run in the compute dtype, while the variables, the QR decompositions, the SVDs
+                             and the network output stay in float32. Default: the global policy
+        :param rank_budget: if set, the rank adaption distributes this budget over all layers (see allocate_ranks)
+                            instead of truncating each layer with tol
+        :param budget_unit: "rank": rank_budget is the sum of the ranks, "flops": rank_budget is the number of flops
+                            per sample of the low-rank layers, 2 * rank * (input_dim + units) each
+        """
         super(DLRANetAdaptive, self).__init__(name=name, **kwargs)
+        if budget_unit not in ("rank", "flops"):
+            raise ValueError("Unknown budget unit: " + str(budget_unit))
+        self.rank_budget = rank_budget
+        self.budget_unit = budget_unit
+        self.adapt_every = adapt_every
+        self.adapt_trigger = adapt_trigger
+        self.adapt_counter = tf.Variable(initial_value=0, trainable=False, name="adapt_counter", dtype=tf.int64)
+        self.adapt_requested = tf.Variable(initial_value=False, trainable=False, name="adapt_requested")
         # dlra_layer_dim = 250
-        self.dlraBlockInput = DLRALayerAdaptive(input_dim=input_dim, units=dlra_layer_dim, low_rank=low_rank,
-                                                epsAdapt=tol,
-                                                rmax_total=rmax_total, )
-        self.dlraBlock1 = DLRALayerAdaptive(input_dim=dlra_layer_dim, units=dlra_layer_dim, low_rank=low_rank,
-                                            epsAdapt=tol,
-                                            rmax_total=rmax_total, )
-        self.dlraBlock2 = DLRALayerAdaptive(input_dim=dlra_layer_dim, units=dlra_layer_dim, low_rank=low_rank,
-                                            epsAdapt=tol,
-                                            rmax_total=rmax_total, )
-        self.dlraBlock3 = DLRALayerAdaptive(input_dim=dlra_layer_dim, units=dlra_layer_dim, low_rank=low_rank,
-                                            epsAdapt=tol,
-                                            rmax_total=rmax_total, )
-        self.dlraBlockOutput = Linear2(input_dim=dlra_layer_dim, units=output_dim)
-
-    def call(self, inputs, step: int = 0):
-        z = self.dlraBlockInput(inputs, step=step)
-        z = self.dlraBlock1(z, step=step)
-        z = self.dlraBlock2(z, step=step)
-        z = self.dlraBlock3(z, step=step)
-        z = self.dlraBlockOutput(z)
-        return z
+        layer_dims = list(layer_dims) if layer_dims is not None else [dlra_layer_dim] * 4
+        if not isinstance(low_rank, (list, tuple)):
+            low_rank = [low_rank] * len(layer_dims)
+        input_dims = [input_dim] + layer_dims[:-1]
+        self.dlra_layers = [DLRALayerAdaptive(input_dim=input_dims[i], units=layer_dims[i], low_rank=low_rank[i],
+                                              epsAdapt=tol, adapt_criterion=adapt_criterion,
+                                              rmax_total=rmax_total, dtype=dtype_policy)
+                            for i in range(len(layer_dims))]
+        self.dlraBlockOutput = Linear2(input_dim=layer_dims[-1], units=output_dim, dtype=dtype_policy)
+
+        # whole integrator step as one graph, the layers keep their variable shapes under rank changes
+        self._compiled_train_step = tf.function(self._train_step)
+        self._compiled_distributed_train_step = tf.function(self._distributed_train_step)
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
+    @tf.function
+    def k_step_postprocessing(self, adapt=False):
         """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
+        orthonormalizes the K factors, with one batched QR decomposition per group of equally shaped layers. The
+        batch is sliced at the largest active rank of the group.
+        :param adapt: boolean (tensor), if true, augment the bases for a rank adaption in this step
         """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
+        for layers in group_by_shape(self.dlra_layers):
+            ranks = [layer.low_rank.read_value() for layer in layers]
+            r_max = tf.reduce_max(ranks)
+            k = [layer.k[:, :r_max] for layer in layers]
+            u = [layer.aux_U[:, :r_max] for layer in layers]
+            tf.cond(adapt, lambda: self.set_k_bases(layers, batched_augmented_qr(k, u, ranks)),
+                    lambda: self.set_k_bases(layers, [(aux_Unp1, None) for aux_Unp1 in batched_qr(k, ranks)]))
         return 0
 
     @staticmethod
-    def set_dlra_bias_grads_to_zero(grads):
+    def set_k_bases(layers, bases):
+        for layer, (aux_Unp1, aux_N) in zip(layers, bases):
+            layer.set_k_basis(aux_Unp1, aux_N)
+        return 0
+
+    @tf.function
+    def l_step_postprocessing(self, adapt=False):
         """
-        :param grads: gradients of current tape
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
+        orthonormalizes the L factors, with one batched QR decomposition per group of equally shaped layers. The
+        batch is sliced at the largest active rank of the group.
+        :param adapt: boolean (tensor), if true, augment the bases for a rank adaption in this step
         """
-        for i in range(len(grads)):
-            if len(grads[i].shape) == 1:
-                grads[i] = tf.math.scalar_mul(0.0, grads[i])
+        for layers in group_by_shape(self.dlra_layers):
+            ranks = [layer.low_rank.read_value() for layer in layers]
+            r_max = tf.reduce_max(ranks)
+            l = [tf.transpose(layer.l_t[:r_max, :]) for layer in layers]
+            v = [tf.transpose(layer.aux_Vt[:r_max, :]) for layer in layers]
+            tf.cond(adapt, lambda: self.set_l_bases(layers, batched_augmented_qr(l, v, ranks)),
+                    lambda: self.set_l_bases(layers, [(aux_Vnp1, None) for aux_Vnp1 in batched_qr(l, ranks)]))
         return 0
 
-    def toggle_non_s_step_training(self):
-        # self.layers[0].trainable = False  # Dense input
-        self.layers[-1].trainable = False  # Dense output
-
+    @staticmethod
+    def set_l_bases(layers, bases):
+        for layer, (aux_Vnp1, aux_M) in zip(layers, bases):
+            layer.set_l_basis(aux_Vnp1, aux_M)
         return 0
 
-    def toggle_s_step_training(self):
-        # self.layers[0].trainable = True  # Dense input
-        self.layers[-1].trainable = True  # Dense output
+    @tf.function
+    def rank_adaption(self, optimizer=None):
+        """
+        truncates the ranks of all layers, with one batched SVD per group of equally shaped layers. Each layer is
+        truncated with tol, or, with a rank_budget, the ranks are allocated over the spectra of all layers.
+        :param optimizer: if a DLRAOptimizer, its moments are truncated with the layers
+        """
+        layers, svds = self.spectra()
+        if self.rank_budget is None:
+            ranks = [layer.adapted_rank(d) for layer, (d, _, _) in zip(layers, svds)]
+        else:
+            ranks = allocate_ranks([d for d, _, _ in svds], self.rank_costs(layers), self.rank_budget,
+                                   [layer.max_rank() for layer in layers])
+        for layer, (d, u2, v2), rank in zip(layers, svds, ranks):
+            layer.truncate(d, u2, v2, rank, optimizer)
         return 0
 
-    def save(self, folder_name):
-        self.dlraBlockInput.save(folder_name=folder_name, layer_id=0)
-        self.dlraBlock1.save(folder_name=folder_name, layer_id=1)
-        self.dlraBlock2.save(folder_name=folder_name, layer_id=2)
-        self.dlraBlock3.save(folder_name=folder_name, layer_id=3)
-        self.dlraBlockOutput.save(folder_name=folder_name, layer_id=4)
+    def spectra(self):
+        """
+        :return: list of the layers and list with the svd (d, u2, v2) of the augmented S of each of them
+        """
+        layers = []
+        svds = []
+        for group in group_by_shape(self.dlra_layers):
+            r_u = [layer.aug_rank_u.read_value() for layer in group]
+            r_v = [layer.aug_rank_v.read_value() for layer in group]
+            s = [layer.s[:tf.reduce_max(r_u), :tf.reduce_max(r_v)] for layer in group]
+            layers += group
+            svds += batched_svd(s, r_u, r_v)
+        return layers, svds
+
+    def rank_costs(self, layers):
+        """
+        :return: cost of one rank of each layer in the unit of the rank budget
+        """
+        if self.budget_unit == "flops":
+            return [2 * (layer.input_dim + layer.units) for layer in layers]
+        return [1 for _ in layers]
+
+    def project_optimizer_state(self, optimizer, adapt):
+        """
+        rotates the moments of a DLRAOptimizer into the new bases, see DLRALayerAdaptive.project_optimizer_state
+        :param adapt: boolean tensor, true if the ranks are truncated in this step
+        """
+        if isinstance(optimizer, DLRAOptimizer):
+            for layer in self.dlra_layers:
+                layer.project_optimizer_state(optimizer, adapt)
         return 0
 
-    def load(self, folder_name):
-        self.dlraBlockInput.load(folder_name=folder_name, layer_id=0)
-        self.dlraBlock1.load(folder_name=folder_name, layer_id=1)
-        self.dlraBlock2.load(folder_name=folder_name, layer_id=2)
-        self.dlraBlock3.load(folder_name=folder_name, layer_id=3)
-        self.dlraBlockOutput.load(folder_name=folder_name, layer_id=4)
+    def ranks(self):
+        """
+        :return: list with the current rank of each low-rank layer, read from the device in one transfer
+        """
+        return tf.stack([layer.low_rank for layer in self.dlra_layers]).numpy().tolist()
+
+    def _train_step(self, x, y, optimizer, timer=None):
+        build_optimizer(optimizer, self.kl_step_variables() + self.s_step_variables())
+        adapt = self.rank_adaption_due()
+
+        # 1.a) K and L Step Preproccessing
+        with phase(timer, "kl_preprocessing") as outputs:
+            outputs.append(self.k_step_preprocessing())
+            outputs.append(self.l_step_preprocessing())
+
+        # 1.b) Tape and apply Gradients for fused K- and L-Step
+        self.kl_step(x, y, optimizer, timer=timer)
+
+        # 2) Postprocessing K and L, with basis augmentation if the ranks are truncated in this step,
+        # S-Step Preprocessing
+        with phase(timer, "qr_postprocessing") as outputs:
+            outputs.append(self.k_step_postprocessing(adapt))
+            outputs.append(self.l_step_postprocessing(adapt))
+        with phase(timer, "s_preprocessing") as outputs:
+            outputs.append(self.s_step_preprocessing())
+            self.project_optimizer_state(optimizer, adapt)
+            outputs.append(self.s_step_variables())
+
+        # 3) Tape and apply Gradients for S-Step
+        loss, out = self.s_step(x, y, optimizer, timer=timer)
+
+        # 4) Rank Adaptivity
+        with phase(timer, "rank_adaption") as outputs:
+            outputs.append(tf.cond(adapt, lambda: self.rank_adaption(optimizer), lambda: 0))
+        return loss, out
+
+    def rank_adaption_due(self):
+        """
+        advances the adaption schedule by one step
+        :return: boolean tensor, true if the ranks are truncated in this step
+        """
+        self.adapt_counter.assign_add(1)
+        adapt = self.adapt_requested.read_value()
+        if self.adapt_every > 0:
+            adapt = tf.logical_or(adapt, self.adapt_counter >= self.adapt_every)
+        if self.adapt_trigger is not None:
+            drift = tf.reduce_max([layer.spectrum_drift() for layer in self.dlra_layers])
+            adapt = tf.logical_or(adapt, drift > self.adapt_trigger)
+        # reset the schedule, if the ranks are truncated
+        self.adapt_counter.assign(tf.where(adapt, tf.constant(0, tf.int64), self.adapt_counter))
+        self.adapt_requested.assign(False)
+        return adapt
+
+    def schedule_rank_adaption(self):
+        """
+        truncates the ranks in the next train_step, e.g. once per epoch with adapt_every=0
+        """
+        self.adapt_requested.assign(True)
         return 0
 
+    def _distributed_train_step(self, x, y, optimizer, strategy):
+        build_optimizer(optimizer, self.kl_step_variables() + self.s_step_variables())
+        adapt = self.rank_adaption_due()
+        self.k_step_preprocessing()
+        self.l_step_preprocessing()
+        strategy.run(self.kl_step, args=(x, y, optimizer))
+        self.k_step_postprocessing(adapt)
+        self.l_step_postprocessing(adapt)
+        self.s_step_preprocessing()
+        self.project_optimizer_state(optimizer, adapt)
+        loss, out = strategy.run(self.s_step, args=(x, y, optimizer))
+        tf.cond(adapt, lambda: self.rank_adaption(optimizer), lambda: 0)
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None), out
+
 
 class Linear2(keras.layers.Layer):
     def __init__(self, units=32, input_dim=32, name="linear", **kwargs):
         super(Linear2, self).__init__(**kwargs)
         self.units = units
         self.w = self.add_weight(shape=(input_dim, units), initializer="random_normal",
-                                 trainable=True, )
-        self.b = self.add_weight(shape=(self.units,), initializer="random_normal", trainable=True)
+                                 trainable=True, name="w_")
+        self.b = self.add_weight(shape=(self.units,), initializer="random_normal", trainable=True, name="b_")
 
     def call(self, inputs):
-        return tf.matmul(inputs, self.w) + self.b
+        w, b = cast_factors(self.compute_dtype, self.w, self.b)
+        return tf.matmul(inputs, w) + b
 
     def get_config(self):
         config = super(Linear2, self).get_config()
         config.update({"units": self.units})
         return config
 
+    def get_arrays(self, layer_id):
+        """
+        :param layer_id: index of the layer in the network
+        :return: dict name -> tensor with the current value of each variable, the names match the .npy files of
+                 save()
+        """
+        return {"w_" + str(layer_id): self.w.read_value(), "b_" + str(layer_id): self.b.read_value()}
+
+    def set_arrays(self, arrays, layer_id):
+        """
+        :param arrays: dict name -> numpy array, as returned by get_arrays() or load_arrays()
+        :param layer_id: index of the layer in the network
+        """
+        a_np = arrays["w_" + str(layer_id)]
+        self.w = tf.Variable(initial_value=a_np,
+                             trainable=True, name="w_", dtype=self.variable_dtype)
+        b_np = arrays["b_" + str(layer_id)]
+        self.b = tf.Variable(initial_value=b_np,
+                             trainable=True, name="b_", dtype=self.variable_dtype)
+        return 0
+
     def save(self, folder_name, layer_id):
-        w_np = self.w.numpy()
-        np.save(folder_name + "/w_" + str(layer_id) + ".npy", w_np)
-        b_np = self.b.numpy()
-        np.save(folder_name + "/b_" + str(layer_id) + ".npy", b_np)
+        for name, value in self.get_arrays(layer_id).items():
+            np.save(folder_name + "/" + name + ".npy", value)
         return 0
 
     def load(self, folder_name, layer_id):
-        a_np = np.load(folder_name + "/w_" + str(layer_id) + ".npy")
-        self.w = tf.Variable(initial_value=a_np,
-                             trainable=True, name="w_", dtype=tf.float32)
-        b_np = np.load(folder_name + "/b_" + str(layer_id) + ".npy")
-        self.b = tf.Variable(initial_value=b_np,
-                             trainable=True, name="b_", dtype=tf.float32)
+        return self.set_arrays(load_arrays(folder_name), layer_id)
 
 
 class DLRALayer(keras.layers.Layer):
@@ -236,11 +685,11 @@ class DLRALayer(keras.layers.Layer):
                                  trainable=True, name="s_")
         self.b = self.add_weight(shape=(self.units,), initializer="random_normal", trainable=True, name="b_")
         # auxiliary variables
-        self.aux_U = self.add_weight(shape=(self.input_dim, self.low_rank), initializer="random_normal",
+        self.aux_U = self.add_weight(shape=(self.input_dim, self.low_rank), initializer="orthogonal",
                                      trainable=False, name="aux_U")
         self.aux_Unp1 = self.add_weight(shape=(self.input_dim, self.low_rank), initializer="random_normal",
                                         trainable=False, name="aux_Unp1")
-        self.aux_Vt = self.add_weight(shape=(self.low_rank, self.units), initializer="random_normal",
+        self.aux_Vt = self.add_weight(shape=(self.low_rank, self.units), initializer="orthogonal",
                                       trainable=False, name="aux_Vt")
         self.aux_Vtnp1 = self.add_weight(shape=(self.low_rank, self.units), initializer="random_normal",
                                          trainable=False, name="aux_Vtnp1")
@@ -252,35 +701,34 @@ class DLRALayer(keras.layers.Layer):
         return 0
 
     @tf.function
-    def call(self, inputs, step: int = 0):
+    def call(self, inputs, step: int = 0, products=None):
         """
         :param inputs: layer input
-        :param step: step conter: k:= 0, l:=1, s:=2
-        :return:
+        :param step: step conter: k:= 0, l:=1, s:=2, fused k and l:=3
+        :param products: factors of the k-step from forward_products, used instead of k and aux_Vt if given
+        :return: for step 3, the outputs of the k- and l-branch stacked along the first axis
         """
-
+        # float32 variables, cast to the compute dtype of a mixed precision policy. The chains of matmuls are
+        # evaluated in the order with the fewest flops for the batch size and the rank, see matmul_chain
         if step == 0:  # k-step
-            z = tf.matmul(tf.matmul(inputs, self.k), self.aux_Vt)
+            factors = (self.k, self.aux_Vt) if products is None else products
+            z = matmul_chain(inputs, *cast_factors(self.compute_dtype, *factors))
         elif step == 1:  # l-step
-            z = tf.matmul(tf.matmul(inputs, self.aux_U), self.l_t)
+            z = matmul_chain(inputs, *cast_factors(self.compute_dtype, self.aux_U, self.l_t))
+        elif step == 3:  # fused k- and l-step
+            z = fused_kl_matmul(inputs, *cast_factors(self.compute_dtype, self.k, self.aux_Vt, self.aux_U, self.l_t))
         else:  # s-step
-            z = tf.matmul(tf.matmul(tf.matmul(inputs, self.aux_Unp1), self.s), self.aux_Vtnp1)
-        return tf.keras.activations.relu(z + self.b)
+            z = matmul_chain(inputs, *cast_factors(self.compute_dtype, self.aux_Unp1, self.s, self.aux_Vtnp1))
+        return tf.keras.activations.relu(z + tf.cast(self.b, self.compute_dtype))
 
-    @tf.function
-    def call(self, inputs, step: int = 0):
+    def forward_products(self):
         """
-        :param inputs: layer input
-        :param step: step conter: k:= 0, l:=1, s:=2
-        :return:
+        :return: the factors of the k-step forward pass inputs @ k @ aux_Vt with the fewest flops per sample: the
+                 merged matrix k aux_Vt if rank * (input_dim + units) > input_dim * units, otherwise k and aux_Vt
         """
-        if step == 0:  # k-step
-            z = tf.matmul(tf.matmul(inputs, self.k), self.aux_Vt)
-        elif step == 1:  # l-step
-            z = tf.matmul(tf.matmul(inputs, self.aux_U), self.l_t)
-        else:  # s-step
-            z = tf.matmul(tf.matmul(tf.matmul(inputs, self.aux_Unp1), self.s), self.aux_Vtnp1)
-        return tf.keras.activations.relu(z + self.b)
+        if self.k.shape[1] * (self.input_dim + self.units) > self.input_dim * self.units:
+            return (tf.matmul(self.k, self.aux_Vt),)
+        return self.k.read_value(), self.aux_Vt.read_value()
 
     @tf.function
     def k_step_preprocessing(self, ):
@@ -291,15 +739,29 @@ class DLRALayer(keras.layers.Layer):
     @tf.function
     def k_step_postprocessing(self):
         aux_Unp1, _ = tf.linalg.qr(self.k)
-        self.aux_Unp1.assign(aux_Unp1)  # = tf.Variable(initial_value=aux_Unp1, trainable=False, name="aux_Unp1")
-        N = tf.matmul(tf.transpose(self.aux_Unp1), self.aux_U)
-        self.aux_N.assign(N)
+        self.set_k_basis(aux_Unp1)
         return 0
 
-    def k_step_postprocessing_adapt(self):
-        aux_Unp1, _ = tf.linalg.qr(tf.concat((self.k, self.aux_U), axis=1))
-        self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1, trainable=False, name="aux_Unp1")
-        self.aux_N = tf.matmul(tf.transpose(self.aux_Unp1), self.aux_U)
+    def flops(self, batch_size, adapt=False):
+        """
+        :param adapt: count a step with basis augmentation and rank adaption, as in DLRALayerAdaptive
+        :return: dict phase -> flops of one training step at the current rank, see step_flops
+        """
+        r = self.low_rank
+        r_u = min(2 * r, self.input_dim) if adapt else r
+        r_v = min(2 * r, self.units) if adapt else r
+        return step_flops(self.input_dim, self.units, r, r_u, r_v, batch_size, adapt=adapt)
+
+    def set_k_basis(self, aux_Unp1, aux_N=None):
+        """
+        :param aux_Unp1: orthonormal basis of the range of k, from k_step_postprocessing or the batched QR of the
+                         network
+        :param aux_N: aux_Unp1^T aux_U, if already known. Otherwise it is computed
+        """
+        self.aux_Unp1.assign(aux_Unp1)  # = tf.Variable(initial_value=aux_Unp1, trainable=False, name="aux_Unp1")
+        if aux_N is None:
+            aux_N = tf.matmul(tf.transpose(self.aux_Unp1), self.aux_U)
+        self.aux_N.assign(aux_N)
         return 0
 
     @tf.function
@@ -311,15 +773,19 @@ class DLRALayer(keras.layers.Layer):
     @tf.function
     def l_step_postprocessing(self):
         aux_Vtnp1, _ = tf.linalg.qr(tf.transpose(self.l_t))
-        self.aux_Vtnp1.assign(tf.transpose(aux_Vtnp1))
-        M = tf.matmul(self.aux_Vtnp1, tf.transpose(self.aux_Vt))
-        self.aux_M.assign(M)
+        self.set_l_basis(aux_Vtnp1)
         return 0
 
-    def l_step_postprocessing_adapt(self):
-        aux_Vtnp1, _ = tf.linalg.qr(tf.concat((tf.transpose(self.l_t), tf.transpose(self.aux_Vt)), axis=1))
-        self.aux_Vtnp1 = tf.transpose(aux_Vtnp1)
-        self.aux_M = tf.matmul(self.aux_Vtnp1, tf.transpose(self.aux_Vt))
+    def set_l_basis(self, aux_Vnp1, aux_M=None):
+        """
+        :param aux_Vnp1: orthonormal basis of the range of l = l_t^T (units x rank), from l_step_postprocessing or the
+                         batched QR of the network
+        :param aux_M: aux_Vtnp1 aux_Vt^T, if already known. Otherwise it is computed
+        """
+        self.aux_Vtnp1.assign(tf.transpose(aux_Vnp1))
+        if aux_M is None:
+            aux_M = tf.matmul(self.aux_Vtnp1, tf.transpose(self.aux_Vt))
+        self.aux_M.assign(aux_M)
         return 0
 
     @tf.function
@@ -330,102 +796,81 @@ class DLRALayer(keras.layers.Layer):
         self.s.assign(s)  # = tf.Variable(initial_value=s, trainable=True, name="s_")
         return 0
 
-    def rank_adaption(self):
-        # 1) compute SVD of S
-        d, u2, v2 = tf.linalg.svd(self.s)  # d=singular values, u2 = left singuar vecs, v2= right singular vecss
-        # print(d.shape)
-        tmp = 0.0
-        tol = self.epsAdapt * tf.linalg.norm(d)  # absolute value treshold (try also relative one)
-        rmax = int(tf.floor(d.shape[0] / 2))
-        for j in range(0, 2 * rmax - 1):
-            tmp = tf.linalg.norm(d[j:2 * rmax - 1])
-            if tmp < tol:
-                rmax = j
-                break
-
-        rmax = tf.minimum(rmax, self.rmax_total)
-        rmax = tf.maximum(rmax, 2)
-
-        # update s
-        self.s = tf.linalg.tensor_diag(d[:rmax])
-        # self.s = s
-
-        # update u and v
-        self.aux_U = tf.matmul(self.aux_U, u2[:, :rmax])
-        self.aux_Vt = tf.matmul(v2[:rmax, :], self.aux_Vt)
-        self.low_rank = rmax
+    def project_optimizer_state(self, optimizer):
+        """
+        rotates the moments of the factors into the bases of the next step, like s_step_preprocessing rotates S. The
+        columns of K and S are coordinates in the basis V, which rotates by aux_M, the rows of L and S in the basis
+        U, which rotates by aux_N.
+        :param optimizer: DLRAOptimizer
+        """
+        optimizer.project(self.s, left=self.aux_N, right=self.aux_M)
+        optimizer.project(self.k, right=self.aux_M)
+        optimizer.project(self.l_t, left=self.aux_N)
         return 0
 
+    def inference_factors(self):
+        """
+        :return: U S and Vt of the current weight matrix W = U S Vt
+        """
+        return tf.matmul(self.aux_U, self.s).numpy(), self.aux_Vt.numpy()
+
     def get_config(self):
         config = super(DLRALayer, self).get_config()
         config.update({"units": self.units})
         config.update({"low_rank": self.low_rank})
         return config
 
-    def save(self, folder_name, layer_id):
-        # main_variables
-        k_np = self.k.numpy()
-        np.save(folder_name + "/k" + str(layer_id) + ".npy", k_np)
-        l_t_np = self.l_t.numpy()
-        np.save(folder_name + "/l_t" + str(layer_id) + ".npy", l_t_np)
-        s_np = self.s.numpy()
-        np.save(folder_name + "/s" + str(layer_id) + ".npy", s_np)
-        b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
-        # aux_variables
-        aux_U_np = self.aux_U.numpy()
-        np.save(folder_name + "/aux_U" + str(layer_id) + ".npy", aux_U_np)
-        aux_Unp1_np = self.aux_Unp1.numpy()
-        np.save(folder_name + "/aux_Unp1" + str(layer_id) + ".npy", aux_Unp1_np)
-        aux_Vt_np = self.aux_Vt.numpy()
-        np.save(folder_name + "/aux_Vt" + str(layer_id) + ".npy", aux_Vt_np)
-        aux_Vtnp1_np = self.aux_Vtnp1.numpy()
-        np.save(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy", aux_Vtnp1_np)
-        aux_N_np = self.aux_N.numpy()
-        np.save(folder_name + "/aux_N" + str(layer_id) + ".npy", aux_N_np)
-        aux_M_np = self.aux_M.numpy()
-        np.save(folder_name + "/aux_M" + str(layer_id) + ".npy", aux_M_np)
-        return 0
-
-    def load(self, folder_name, layer_id):
-
+    def get_arrays(self, layer_id, compact=False):
+        """
+        :param layer_id: index of the layer in the network
+        :param compact: if true, only the factors U, S, Vt and the bias, see compact_arrays
+        :return: dict name -> tensor with the current value of each variable, the names match the .npy files of
+                 save()
+        """
+        if compact:
+            return compact_arrays(self.aux_U.read_value(), self.s.read_value(), self.aux_Vt.read_value(),
+                                  self.b.read_value(), layer_id)
+        return {
+            "k" + str(layer_id): self.k.read_value(),
+            "l_t" + str(layer_id): self.l_t.read_value(),
+            "s" + str(layer_id): self.s.read_value(),
+            "b" + str(layer_id): self.b.read_value(),
+            "aux_U" + str(layer_id): self.aux_U.read_value(),
+            "aux_Unp1" + str(layer_id): self.aux_Unp1.read_value(),
+            "aux_Vt" + str(layer_id): self.aux_Vt.read_value(),
+            "aux_Vtnp1" + str(layer_id): self.aux_Vtnp1.read_value(),
+            "aux_N" + str(layer_id): self.aux_N.read_value(),
+            "aux_M" + str(layer_id): self.aux_M.read_value(),
+        }
+
+    def set_arrays(self, arrays, layer_id):
+        """
+        :param arrays: dict name -> numpy array, as returned by get_arrays() or load_arrays(), full or compact
+        :param layer_id: index of the layer in the network
+        """
         # main variables
-        k_np = np.load(folder_name + "/k" + str(layer_id) + ".npy")
+        s_np, k_np, l_t_np = expand_arrays(arrays, layer_id)
         self.low_rank = k_np.shape[1]
         self.k = tf.Variable(initial_value=k_np,
-                             trainable=True, name="k_", dtype=tf.float32)
-        l_t_np = np.load(folder_name + "/l_t" + str(layer_id) + ".npy")
+                             trainable=True, name="k_", dtype=self.variable_dtype)
         self.l_t = tf.Variable(initial_value=l_t_np,
-                               trainable=True, name="lt_", dtype=tf.float32)
-        s_np = np.load(folder_name + "/s" + str(layer_id) + ".npy")
+                               trainable=True, name="lt_", dtype=self.variable_dtype)
         self.s = tf.Variable(initial_value=s_np,
-                             trainable=True, name="s_", dtype=tf.float32)
-        bias = np.load(folder_name + "/b" + str(layer_id) + ".npy")
+                             trainable=True, name="s_", dtype=self.variable_dtype)
+        bias = arrays["b" + str(layer_id)]
         self.b = tf.Variable(initial_value=bias,
-                             trainable=True, name="b_", dtype=tf.float32)
+                             trainable=True, name="b_", dtype=self.variable_dtype)
 
         # aux variables
-        aux_U_np = np.load(folder_name + "/aux_U" + str(layer_id) + ".npy")
+        aux_U_np = arrays["aux_U" + str(layer_id)]
         self.aux_U = tf.Variable(initial_value=aux_U_np,
-                                 trainable=False, name="aux_U", dtype=tf.float32)
-        aux_Unp1_np = np.load(folder_name + "/aux_Unp1" + str(layer_id) + ".npy")
-        self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1_np,
-                                    trainable=False, name="aux_Unp1", dtype=tf.float32)
-        Vt_np = np.load(folder_name + "/aux_Vt" + str(layer_id) + ".npy")
+                                 trainable=False, name="aux_U", dtype=self.variable_dtype)
+        Vt_np = arrays["aux_Vt" + str(layer_id)]
         self.aux_Vt = tf.Variable(initial_value=Vt_np,
-                                  trainable=False, name="aux_Vt", dtype=tf.float32)
-        vtnp1_np = np.load(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy")
-        self.aux_Vtnp1 = tf.Variable(initial_value=vtnp1_np,
-                                     trainable=False, name="aux_Vtnp1", dtype=tf.float32)
-        aux_N_np = np.load(folder_name + "/aux_N" + str(layer_id) + ".npy")
-        self.aux_N = tf.Variable(initial_value=aux_N_np,
-                                 trainable=False, name="aux_N", dtype=tf.float32)
-        aux_M_np = np.load(folder_name + "/aux_M" + str(layer_id) + ".npy")
-        self.aux_M = tf.Variable(initial_value=aux_M_np,
-                                 trainable=False, name="aux_M", dtype=tf.float32)
-
-        # build model, but only
-        # auxiliary variables, since in adaptive rank training, these have different shapes
+                                  trainable=False, name="aux_Vt", dtype=self.variable_dtype)
+
+        # aux_Unp1, aux_Vtnp1, aux_N and aux_M only carry values between the sub steps of one training step,
+        # so they are not restored, but rebuilt at the loaded rank
 
         self.aux_Unp1 = self.add_weight(shape=(self.input_dim, self.low_rank), initializer="random_normal",
                                         trainable=False, name="aux_Unp1")
@@ -439,17 +884,37 @@ class DLRALayer(keras.layers.Layer):
 
         return 0
 
-    def load_from_fullW(self, folder_name, layer_id, rank):
+    def save(self, folder_name, layer_id, compact=False):
+        arrays = self.get_arrays(layer_id, compact=compact)
+        for name, value in (compact_coefficients(arrays) if compact else arrays).items():
+            np.save(folder_name + "/" + name + ".npy", value)
+        return 0
 
-        W_mat = np.load(folder_name + "/w_" + str(layer_id) + ".npy")
-        d, u, v = tf.linalg.svd(W_mat)  # d=singular values, u2 = left singuar vecs, v2= right singular vecss
+    def load(self, folder_name, layer_id):
+        return self.set_arrays(load_arrays(folder_name), layer_id)
+
+    def load_from_fullW(self, folder_name, layer_id, rank, svd="full", oversampling=10, power_iterations=2):
+        """
+        :param svd: "full": truncate the full svd of W, "randomized": compute only the leading rank singular triplets
+                    with randomized_svd, which is much cheaper for wide layers
+        :param oversampling: see randomized_svd
+        :param power_iterations: see randomized_svd
+        """
+
+        W_mat = load_arrays(folder_name)["w_" + str(layer_id)]
+        if svd == "full":
+            d, u, v = tf.linalg.svd(W_mat)  # d=singular values, u2 = left singuar vecs, v2= right singular vecss
+        elif svd == "randomized":
+            d, u, v = randomized_svd(W_mat, rank, oversampling=oversampling, power_iterations=power_iterations)
+        else:
+            raise ValueError("Unknown svd: " + str(svd))
 
         s_init = tf.linalg.tensor_diag(d[:rank])
         u_init = u[:, :rank]
-        v_init = u[:rank, :]
-        self.s = tf.Variable(initial_value=s_init, trainable=True, name="s_", dtype=tf.float32)
-        self.aux_Vt = tf.Variable(initial_value=v_init, trainable=True, name="Vt", dtype=tf.float32)
-        self.aux_U = tf.Variable(initial_value=u_init, trainable=True, name="aux_U", dtype=tf.float32)
+        v_init = tf.transpose(v[:, :rank])
+        self.s = tf.Variable(initial_value=s_init, trainable=True, name="s_", dtype=self.variable_dtype)
+        self.aux_Vt = tf.Variable(initial_value=v_init, trainable=True, name="Vt", dtype=self.variable_dtype)
+        self.aux_U = tf.Variable(initial_value=u_init, trainable=True, name="aux_U", dtype=self.variable_dtype)
 
         self.k_step_preprocessing()
         self.l_step_preprocessing()
@@ -459,189 +924,363 @@ class DLRALayer(keras.layers.Layer):
 
 class DLRALayerAdaptive(keras.layers.Layer):
     def __init__(self, input_dim: int, units=32, low_rank=10, epsAdapt=0.1, rmax_total=100, name="dlra_block",
-                 **kwargs):
+                 adapt_criterion="relative", **kwargs):
         super(DLRALayerAdaptive, self).__init__(**kwargs)
         self.epsAdapt = epsAdapt  # for unconventional integrator
+        self.adapt_criterion = adapt_criterion  # see truncation_rank
         self.units = units
-        self.low_rank = low_rank
         self.rmax_total = rmax_total
         self.input_dim = input_dim
 
-        self.k = self.add_weight(shape=(input_dim, self.low_rank), initializer="random_normal",
+        # All factors are preallocated at the largest rank the integrator can reach, so that the variables keep
+        # their shape over the whole training. Only the leading block of each buffer is active:
+        # low_rank columns of k, aux_U and rows of l_t, aux_Vt, and aug_rank_u columns of aux_Unp1 and aug_rank_v
+        # rows of aux_Vtnp1 (the bases after the K and L step, which have up to twice the rank).
+        self.rank_capacity = min(max(low_rank, rmax_total), input_dim, units)
+        self.aug_capacity_u = min(2 * self.rank_capacity, input_dim)
+        self.aug_capacity_v = min(2 * self.rank_capacity, units)
+        self.low_rank = tf.Variable(initial_value=low_rank, trainable=False, name="low_rank", dtype=tf.int32)
+        self.aug_rank_u = tf.Variable(initial_value=low_rank, trainable=False, name="aug_rank_u", dtype=tf.int32)
+        self.aug_rank_v = tf.Variable(initial_value=low_rank, trainable=False, name="aug_rank_v", dtype=tf.int32)
+
+        self.k = self.add_weight(shape=(input_dim, self.rank_capacity), initializer="random_normal",
                                  trainable=True, name="k_")
-        self.l_t = self.add_weight(shape=(self.low_rank, self.units), initializer="random_normal",
+        self.l_t = self.add_weight(shape=(self.rank_capacity, self.units), initializer="random_normal",
                                    trainable=True, name="lt_")
-        self.s = self.add_weight(shape=(self.low_rank, self.low_rank), initializer="random_normal",
+        self.s = self.add_weight(shape=(self.aug_capacity_u, self.aug_capacity_v), initializer="random_normal",
                                  trainable=True, name="s_")
         self.b = self.add_weight(shape=(self.units,), initializer="random_normal", trainable=True, name="b_")
         # auxiliary variables
-        self.aux_U = self.add_weight(shape=(self.input_dim, self.low_rank), initializer="random_normal",
+        self.aux_U = self.add_weight(shape=(self.input_dim, self.aug_capacity_u), initializer="orthogonal",
                                      trainable=False, name="aux_U")
-        self.aux_Unp1 = self.add_weight(shape=(self.input_dim, self.low_rank), initializer="random_normal",
+        self.aux_Unp1 = self.add_weight(shape=(self.input_dim, self.aug_capacity_u), initializer="random_normal",
                                         trainable=False, name="aux_Unp1")
-        self.aux_Vt = self.add_weight(shape=(self.low_rank, self.units), initializer="random_normal",
+        self.aux_Vt = self.add_weight(shape=(self.aug_capacity_v, self.units), initializer="orthogonal",
                                       trainable=False, name="Vt")
-        self.aux_Vtnp1 = self.add_weight(shape=(self.low_rank, self.units), initializer="random_normal",
+        self.aux_Vtnp1 = self.add_weight(shape=(self.aug_capacity_v, self.units), initializer="random_normal",
                                          trainable=False, name="vtnp1")
-        self.aux_N = self.add_weight(shape=(self.low_rank, self.low_rank), initializer="random_normal",
+        self.aux_N = self.add_weight(shape=(self.aug_capacity_u, self.aug_capacity_u), initializer="random_normal",
                                      trainable=False, name="aux_N")
-        self.aux_M = self.add_weight(shape=(self.low_rank, self.low_rank), initializer="random_normal",
+        self.aux_M = self.add_weight(shape=(self.aug_capacity_v, self.aug_capacity_v), initializer="random_normal",
                                      trainable=False, name="aux_M")
+        # singular values kept at the last rank adaption or load, zero until then
+        self.aux_sigma = self.add_weight(shape=(self.rank_capacity,), initializer="zeros", trainable=False,
+                                         name="aux_sigma")
         # Todo: initializer with low rank
 
-    def call(self, inputs, step: int = 0):
+    @tf.function
+    def call(self, inputs, step: int = 0, products=None):
         """
         :param
         inputs: layer
         input
         :param
         step: step
-        conter: k := 0, l := 1, s := 2
-        :return:
+        conter: k := 0, l := 1, s := 2, fused k and l := 3
+        :param products: factors of the k-step from forward_products, used instead of k and aux_Vt if given
+        :return: for step 3, the outputs of the k- and l-branch stacked along the first axis
         """
-        if step == 0:  # k-step
-            z = tf.matmul(tf.matmul(inputs, self.k), self.aux_Vt)
+        r = self.low_rank
+        # float32 variables, cast to the compute dtype of a mixed precision policy. The chains of matmuls are
+        # evaluated in the order with the fewest flops for the batch size and the current ranks, see matmul_chain
+        if step == 0 and products is not None:  # k-step, pre-multiplied factors
+            merge, merged, k, aux_Vt = products
+            merged, k, aux_Vt = cast_factors(self.compute_dtype, merged, k, aux_Vt)
+            z = tf.cond(merge, lambda: tf.matmul(inputs, merged), lambda: matmul_chain(inputs, k, aux_Vt))
+        elif step == 0:  # k-step
+            z = matmul_chain(inputs, *cast_factors(self.compute_dtype, self.k[:, :r], self.aux_Vt[:r, :]))
         elif step == 1:  # l-step
-            z = tf.matmul(tf.matmul(inputs, self.aux_U), self.l_t)
+            z = matmul_chain(inputs, *cast_factors(self.compute_dtype, self.aux_U[:, :r], self.l_t[:r, :]))
+        elif step == 3:  # fused k- and l-step
+            z = fused_kl_matmul(inputs, *cast_factors(self.compute_dtype, self.k[:, :r], self.aux_Vt[:r, :],
+                                                      self.aux_U[:, :r], self.l_t[:r, :]))
         else:  # s-step
-            z = tf.matmul(tf.matmul(tf.matmul(inputs, self.aux_Unp1), self.s), self.aux_Vtnp1)
-        return tf.keras.activations.relu(z + self.b)
+            r_u = self.aug_rank_u
+            r_v = self.aug_rank_v
+            z = matmul_chain(inputs, *cast_factors(self.compute_dtype, self.aux_Unp1[:, :r_u], self.s[:r_u, :r_v],
+                                                   self.aux_Vtnp1[:r_v, :]))
+        return tf.keras.activations.relu(z + tf.cast(self.b, self.compute_dtype))
 
+    @tf.function
+    def forward_products(self):
+        """
+        see DLRALayer.forward_products. The rank is only known in the graph, so both variants are returned
+        :return: (merge, merged matrix k aux_Vt (empty if not merge), k, aux_Vt) at the current rank
+        """
+        r = self.low_rank
+        k = self.k[:, :r]
+        aux_Vt = self.aux_Vt[:r, :]
+        merge = r * (self.input_dim + self.units) > self.input_dim * self.units
+        merged = tf.cond(merge, lambda: tf.matmul(k, aux_Vt), lambda: tf.zeros((0, self.units), dtype=k.dtype))
+        return merge, merged, k, aux_Vt
+
+    @tf.function
     def k_step_preprocessing(self, ):
-        k = tf.matmul(self.aux_U, self.s)
-        self.k = tf.Variable(initial_value=k, trainable=True, name="k_")
+        r = self.low_rank
+        k = tf.matmul(self.aux_U[:, :r], self.s[:r, :r])
+        assign_padded(self.k, k)
         return 0
 
+    @tf.function
     def k_step_postprocessing(self):
-        aux_Unp1, _ = tf.linalg.qr(self.k)
-        self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1, trainable=False, name="aux_Unp1")
-        N = tf.matmul(tf.transpose(self.aux_Unp1), self.aux_U)
-        self.aux_N.assign(N)
+        r = self.low_rank
+        aux_Unp1, _ = tf.linalg.qr(self.k[:, :r])
+        self.set_k_basis(aux_Unp1)
         return 0
 
+    @tf.function
     def k_step_postprocessing_adapt(self):
-        aux_Unp1, _ = tf.linalg.qr(tf.concat((self.k, self.aux_U), axis=1))
-        self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1, trainable=False, name="aux_Unp1")
-        self.aux_N = tf.matmul(tf.transpose(self.aux_Unp1), self.aux_U)
+        r = self.low_rank
+        # augmented basis, has min(input_dim, 2r) columns
+        aux_Unp1, aux_N = augmented_basis(self.k[:, :r], self.aux_U[:, :r])
+        self.set_k_basis(aux_Unp1, aux_N)
         return 0
 
+    def flops(self, batch_size, adapt=False):
+        """
+        :param adapt: count the augmented postprocessing and the rank adaption
+        :return: dict phase -> flops of one training step at the current rank, see step_flops
+        """
+        r = int(self.low_rank)
+        r_u = min(2 * r, self.input_dim) if adapt else r
+        r_v = min(2 * r, self.units) if adapt else r
+        return step_flops(self.input_dim, self.units, r, r_u, r_v, batch_size, adapt=adapt)
+
+    def set_k_basis(self, aux_Unp1, aux_N=None):
+        """
+        :param aux_Unp1: orthonormal basis after the K step with r columns, or up to 2r columns if augmented
+        :param aux_N: aux_Unp1^T aux_U[:, :r], if already known. Otherwise it is computed
+        """
+        r = self.low_rank
+        if aux_N is None:
+            aux_N = tf.matmul(aux_Unp1, self.aux_U[:, :r], transpose_a=True)
+        assign_padded(self.aux_Unp1, aux_Unp1)
+        assign_padded(self.aux_N, aux_N)
+        self.aug_rank_u.assign(tf.shape(aux_Unp1)[1])
+        return 0
+
+    @tf.function
     def l_step_preprocessing(self, ):
-        l_t = tf.matmul(self.s, self.aux_Vt)
-        self.l_t = tf.Variable(initial_value=l_t, trainable=True, name="lt_")
+        r = self.low_rank
+        l_t = tf.matmul(self.s[:r, :r], self.aux_Vt[:r, :])
+        assign_padded(self.l_t, l_t)
         return 0
 
+    @tf.function
     def l_step_postprocessing(self):
-        aux_Vtnp1, _ = tf.linalg.qr(tf.transpose(self.l_t))
-        self.aux_Vtnp1.assign(tf.transpose(aux_Vtnp1))
-        M = tf.matmul(self.aux_Vtnp1, tf.transpose(self.aux_Vt))
-        self.aux_M.assign(M)
+        r = self.low_rank
+        aux_Vnp1, _ = tf.linalg.qr(tf.transpose(self.l_t[:r, :]))
+        self.set_l_basis(aux_Vnp1)
         return 0
 
+    @tf.function
     def l_step_postprocessing_adapt(self):
-        aux_Vtnp1, _ = tf.linalg.qr(tf.concat((tf.transpose(self.l_t), tf.transpose(self.aux_Vt)), axis=1))
-        self.aux_Vtnp1 = tf.transpose(aux_Vtnp1)
-        self.aux_M = tf.matmul(self.aux_Vtnp1, tf.transpose(self.aux_Vt))
+        r = self.low_rank
+        # augmented basis, has min(units, 2r) columns
+        aux_Vnp1, aux_M = augmented_basis(tf.transpose(self.l_t[:r, :]), tf.transpose(self.aux_Vt[:r, :]))
+        self.set_l_basis(aux_Vnp1, aux_M)
+        return 0
+
+    def set_l_basis(self, aux_Vnp1, aux_M=None):
+        """
+        :param aux_Vnp1: orthonormal basis after the L step (units x columns) with r columns, or up to 2r columns if
+                         augmented
+        :param aux_M: aux_Vnp1^T aux_Vt[:r, :]^T, if already known. Otherwise it is computed
+        """
+        r = self.low_rank
+        if aux_M is None:
+            aux_M = tf.matmul(aux_Vnp1, self.aux_Vt[:r, :], transpose_a=True, transpose_b=True)
+        assign_padded(self.aux_Vtnp1, tf.transpose(aux_Vnp1))
+        assign_padded(self.aux_M, aux_M)
+        self.aug_rank_v.assign(tf.shape(aux_Vnp1)[1])
         return 0
 
-    # @tf.function
+    @tf.function
     def s_step_preprocessing(self):
-        self.aux_U = self.aux_Unp1
-        self.aux_Vt = self.aux_Vtnp1
-        s = tf.matmul(tf.matmul(self.aux_N, self.s), tf.transpose(self.aux_M))
-        self.s = tf.Variable(initial_value=s, trainable=True, name="s_")
+        r = self.low_rank
+        r_u = self.aug_rank_u
+        r_v = self.aug_rank_v
+        s = tf.matmul(tf.matmul(self.aux_N[:r_u, :r], self.s[:r, :r]), self.aux_M[:r_v, :r], transpose_b=True)
+        self.aux_U.assign(self.aux_Unp1)
+        self.aux_Vt.assign(self.aux_Vtnp1)
+        assign_padded(self.s, s)
+        return 0
+
+    def project_optimizer_state(self, optimizer, adapt):
+        """
+        rotates the moments of the factors into the bases of the next step, see DLRALayer.project_optimizer_state.
+        If the ranks are truncated in this step, the moments of K and L are projected in truncate, directly into the
+        truncated bases.
+        :param optimizer: DLRAOptimizer
+        :param adapt: boolean tensor, true if the ranks are truncated in this step
+        """
+        r = self.low_rank
+        aux_N = self.aux_N[:self.aug_rank_u, :r]
+        aux_M = self.aux_M[:self.aug_rank_v, :r]
+        optimizer.project(self.s, left=aux_N, right=aux_M)
+        tf.cond(adapt, lambda: 0, lambda: self.project_kl_optimizer_state(optimizer, aux_N, aux_M))
+        return 0
+
+    def project_kl_optimizer_state(self, optimizer, left, right):
+        """
+        :param left: transformation of the rows of L (new rank x current rank)
+        :param right: transformation of the columns of K (new rank x current rank)
+        """
+        optimizer.project(self.k, right=right)
+        optimizer.project(self.l_t, left=left)
         return 0
 
+    @tf.function
     def rank_adaption(self):
+        r_u = self.aug_rank_u
+        r_v = self.aug_rank_v
         # 1) compute SVD of S
-        d, u2, v2 = tf.linalg.svd(self.s)  # d=singular values, u2 = left singuar vecs, v2= right singular vecss
-        # print(d.shape)
-        tmp = 0.0
-        tol = self.epsAdapt * tf.linalg.norm(d)  # absolute value treshold (try also relative one)
-        rmax = int(tf.floor(d.shape[0] / 2))
-        for j in range(0, 2 * rmax - 1):
-            tmp = tf.linalg.norm(d[j:2 * rmax - 1])
-            if tmp < tol:
-                rmax = j
-                break
+        # d = singular values, u2 = left singular vectors, v2 = right singular vectors
+        d, u2, v2 = tf.linalg.svd(self.s[:r_u, :r_v])
+        return self.truncate(d, u2, v2, self.adapted_rank(d))
 
+    def adapted_rank(self, d):
+        """
+        :param d: singular values of S[:aug_rank_u, :aug_rank_v]
+        :return: rank of the spectrum truncated with epsAdapt, between 2 and rmax_total
+        """
+        rmax = truncation_rank(d, self.epsAdapt, criterion=self.adapt_criterion)
         rmax = tf.minimum(rmax, self.rmax_total)
-        rmax = tf.maximum(rmax, 2)
+        return tf.maximum(rmax, 2)
+
+    def max_rank(self):
+        """
+        :return: largest rank the layer can be truncated to
+        """
+        return min(self.rmax_total, self.rank_capacity)
+
+    def truncate(self, d, u2, v2, rmax, optimizer=None):
+        """
+        truncates the rank of the layer, given the svd of its augmented S, from rank_adaption or the batched SVD of
+        the network
+        :param d: singular values of S[:aug_rank_u, :aug_rank_v]
+        :param u2: left singular vectors (aug_rank_u x len(d))
+        :param v2: right singular vectors (aug_rank_v x len(d))
+        :param rmax: new rank, e.g. from adapted_rank or allocate_ranks
+        :param optimizer: if a DLRAOptimizer, its moments are projected to the truncated bases
+        """
+        r_u = self.aug_rank_u
+        r_v = self.aug_rank_v
+
+        if isinstance(optimizer, DLRAOptimizer):
+            # S-step moments from the augmented bases, K- and L-step moments from the bases before this step
+            r = self.low_rank
+            u2_r = u2[:, :rmax]
+            v2_r = v2[:, :rmax]
+            optimizer.project(self.s, left=tf.transpose(u2_r), right=tf.transpose(v2_r))
+            self.project_kl_optimizer_state(optimizer, tf.matmul(u2_r, self.aux_N[:r_u, :r], transpose_a=True),
+                                            tf.matmul(v2_r, self.aux_M[:r_v, :r], transpose_a=True))
 
         # update s
-        self.s = tf.linalg.tensor_diag(d[:rmax])
-        # self.s = s
+        assign_padded(self.s, tf.linalg.tensor_diag(d[:rmax]))
+        self.aux_sigma.assign(tf.pad(d[:rmax], [[0, self.rank_capacity - rmax]]))
 
         # update u and v
-        self.aux_U = tf.matmul(self.aux_U, u2[:, :rmax])
-        self.aux_Vt = tf.matmul(v2[:rmax, :], self.aux_Vt)
-        self.low_rank = rmax
+        assign_padded(self.aux_U, tf.matmul(self.aux_U[:, :r_u], u2[:, :rmax]))
+        assign_padded(self.aux_Vt, tf.matmul(v2[:, :rmax], self.aux_Vt[:r_v, :], transpose_a=True))
+        self.low_rank.assign(rmax)
         return 0
 
-    def get_config(self):
-        config = super(DLRALayer, self).get_config()
-        config.update({"units": self.units})
-        config.update({"low_rank": self.low_rank})
-        return config
+    @tf.function
+    def spectrum_drift(self):
+        """
+        cheap estimate of how much the singular values of S changed since the last rank adaption
+        :return: relative change of |diag(S)| with respect to the singular values kept at the last rank adaption, 0
+                 before the first rank adaption or load, as the diagonal of the initial S is no spectrum
+        """
+        r = self.low_rank
+        sigma = self.aux_sigma[:r]
+        norm = tf.linalg.norm(sigma)
+        change = tf.linalg.norm(tf.abs(tf.linalg.diag_part(self.s[:r, :r])) - sigma)
+        return tf.where(norm > 0, change / tf.maximum(norm, np.finfo(np.float32).tiny), tf.zeros_like(norm))
 
-    def save(self, folder_name, layer_id):
-        # main_variables
-        k_np = self.k.numpy()
-        np.save(folder_name + "/k" + str(layer_id) + ".npy", k_np)
-        l_t_np = self.l_t.numpy()
-        np.save(folder_name + "/l_t" + str(layer_id) + ".npy", l_t_np)
-        s_np = self.s.numpy()
-        np.save(folder_name + "/s" + str(layer_id) + ".npy", s_np)
-        b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
-        # aux_variables
-        aux_U_np = self.aux_U.numpy()
-        np.save(folder_name + "/aux_U" + str(layer_id) + ".npy", aux_U_np)
-        aux_Unp1_np = self.aux_Unp1.numpy()
-        np.save(folder_name + "/aux_Unp1" + str(layer_id) + ".npy", aux_Unp1_np)
-        aux_Vt_np = self.aux_Vt.numpy()
-        np.save(folder_name + "/aux_Vt" + str(layer_id) + ".npy", aux_Vt_np)
-        aux_Vtnp1_np = self.aux_Vtnp1.numpy()
-        np.save(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy", aux_Vtnp1_np)
-        aux_N_np = self.aux_N.numpy()
-        np.save(folder_name + "/aux_N" + str(layer_id) + ".npy", aux_N_np)
-        aux_M_np = self.aux_M.numpy()
-        np.save(folder_name + "/aux_M" + str(layer_id) + ".npy", aux_M_np)
-        return 0
+    def inference_factors(self):
+        """
+        :return: U S and Vt of the current weight matrix W = U S Vt, at the active rank
+        """
+        r = int(self.low_rank)
+        return tf.matmul(self.aux_U[:, :r], self.s[:r, :r]).numpy(), self.aux_Vt[:r, :].numpy()
 
-    def load(self, folder_name, layer_id):
+    def get_config(self):
+        config = super(DLRALayerAdaptive, self).get_config()
+        config.update({"input_dim": self.input_dim, "units": self.units, "low_rank": int(self.low_rank.numpy()),
+                       "epsAdapt": self.epsAdapt, "rmax_total": self.rmax_total,
+                       "adapt_criterion": self.adapt_criterion})
+        return config
 
+    def get_arrays(self, layer_id, compact=False):
+        """
+        :param layer_id: index of the layer in the network
+        :param compact: if true, only the factors U, S, Vt and the bias, see compact_arrays
+        :return: dict name -> tensor with the current active block of each variable, the names match the .npy files
+                 of save()
+        """
+        r = int(self.low_rank)
+        r_u = int(self.aug_rank_u)
+        r_v = int(self.aug_rank_v)
+        if compact:
+            return compact_arrays(self.aux_U[:, :r], self.s[:r, :r], self.aux_Vt[:r, :],
+                                  self.b.read_value(), layer_id)
+        return {
+            "k" + str(layer_id): self.k[:, :r],
+            "l_t" + str(layer_id): self.l_t[:r, :],
+            "s" + str(layer_id): self.s[:r, :r],
+            "b" + str(layer_id): self.b.read_value(),
+            "aux_U" + str(layer_id): self.aux_U[:, :r],
+            "aux_Unp1" + str(layer_id): self.aux_Unp1[:, :r_u],
+            "aux_Vt" + str(layer_id): self.aux_Vt[:r, :],
+            "aux_Vtnp1" + str(layer_id): self.aux_Vtnp1[:r_v, :],
+            "aux_N" + str(layer_id): self.aux_N[:r_u, :r],
+            "aux_M" + str(layer_id): self.aux_M[:r_v, :r],
+        }
+
+    def set_arrays(self, arrays, layer_id):
+        """
+        :param arrays: dict name -> numpy array, as returned by get_arrays() or load_arrays(), full or compact
+        :param layer_id: index of the layer in the network
+        """
         # main variables
-        k_np = np.load(folder_name + "/k" + str(layer_id) + ".npy")
-        self.low_rank = k_np.shape[1]
-        self.k = tf.Variable(initial_value=k_np,
-                             trainable=True, name="k_", dtype=tf.float32)
-        l_t_np = np.load(folder_name + "/l_t" + str(layer_id) + ".npy")
-        self.l_t = tf.Variable(initial_value=l_t_np,
-                               trainable=True, name="lt_", dtype=tf.float32)
-        s_np = np.load(folder_name + "/s" + str(layer_id) + ".npy")
-        self.s = tf.Variable(initial_value=s_np,
-                             trainable=True, name="s_", dtype=tf.float32)
+        s_np, k_np, l_t_np = expand_arrays(arrays, layer_id)
+        r = s_np.shape[0]
+        self.low_rank.assign(r)
+        assign_padded(self.s, s_np)
+        self.aux_sigma.assign(np.pad(np.abs(np.diagonal(s_np)), (0, self.rank_capacity - min(s_np.shape))))
+        assign_padded(self.k, k_np)
+        assign_padded(self.l_t, l_t_np)
+        bias = arrays["b" + str(layer_id)]
+        self.b.assign(bias)
         # aux variables
-        aux_U_np = np.load(folder_name + "/aux_U" + str(layer_id) + ".npy")
-        self.aux_U = tf.Variable(initial_value=aux_U_np,
-                                 trainable=True, name="aux_U", dtype=tf.float32)
-        aux_Unp1_np = np.load(folder_name + "/aux_Unp1" + str(layer_id) + ".npy")
-        self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1_np,
-                                    trainable=True, name="aux_Unp1", dtype=tf.float32)
-        Vt_np = np.load(folder_name + "/aux_Vt" + str(layer_id) + ".npy")
-        self.aux_Vt = tf.Variable(initial_value=Vt_np,
-                                  trainable=True, name="Vt", dtype=tf.float32)
-        vtnp1_np = np.load(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy")
-        self.aux_Vtnp1 = tf.Variable(initial_value=vtnp1_np,
-                                     trainable=True, name="vtnp1", dtype=tf.float32)
-        aux_N_np = np.load(folder_name + "/aux_N" + str(layer_id) + ".npy")
-        self.aux_N = tf.Variable(initial_value=aux_N_np,
-                                 trainable=True, name="aux_N", dtype=tf.float32)
-        aux_M_np = np.load(folder_name + "/aux_M" + str(layer_id) + ".npy")
-        self.aux_M = tf.Variable(initial_value=aux_M_np,
-                                 trainable=True, name="aux_M", dtype=tf.float32)
+        aux_U_np = arrays["aux_U" + str(layer_id)]
+        assign_padded(self.aux_U, aux_U_np)
+        Vt_np = arrays["aux_Vt" + str(layer_id)]
+        assign_padded(self.aux_Vt, Vt_np)
+        # compact checkpoints have no augmented bases, the next K and L step recomputes them
+        aux_Unp1_np = arrays.get("aux_Unp1" + str(layer_id), aux_U_np)
+        self.aug_rank_u.assign(aux_Unp1_np.shape[1])
+        assign_padded(self.aux_Unp1, aux_Unp1_np)
+        vtnp1_np = arrays.get("aux_Vtnp1" + str(layer_id), Vt_np)
+        self.aug_rank_v.assign(vtnp1_np.shape[0])
+        assign_padded(self.aux_Vtnp1, vtnp1_np)
+        aux_N_np = arrays.get("aux_N" + str(layer_id), np.eye(aux_Unp1_np.shape[1], r, dtype=np.float32))
+        assign_padded(self.aux_N, aux_N_np)
+        aux_M_np = arrays.get("aux_M" + str(layer_id), np.eye(vtnp1_np.shape[0], r, dtype=np.float32))
+        assign_padded(self.aux_M, aux_M_np)
+        return 0
+
+    def save(self, folder_name, layer_id, compact=False):
+        arrays = self.get_arrays(layer_id, compact=compact)
+        for name, value in (compact_coefficients(arrays) if compact else arrays).items():
+            np.save(folder_name + "/" + name + ".npy", value)
         return 0
 
+    def load(self, folder_name, layer_id):
+        return self.set_arrays(load_arrays(folder_name), layer_id)
+
 
 class ReferenceNet(keras.Model):
 
@@ -653,6 +1292,10 @@ class ReferenceNet(keras.Model):
         self.layer4 = Linear2(units=layer_dim, input_dim=layer_dim)
         self.layer5 = Linear2(units=output_dim, input_dim=layer_dim)
 
+        # metrics of evaluate(), accumulated in the graph over all batches
+        self.eval_loss_metric = tf.keras.metrics.Mean(name="eval_loss")
+        self.eval_acc_metric = tf.keras.metrics.SparseCategoricalAccuracy(name="eval_accuracy")
+
     @tf.function
     def call(self, inputs):
         z = self.layer1(inputs)
@@ -666,17 +1309,510 @@ class ReferenceNet(keras.Model):
         z = self.layer5(z)
         return z
 
-    def save(self, folder_name):
-        self.layer1.save(folder_name, layer_id=0)
-        self.layer2.save(folder_name, layer_id=1)
-        self.layer3.save(folder_name, layer_id=2)
-        self.layer4.save(folder_name, layer_id=3)
-        self.layer5.save(folder_name, layer_id=4)
-        return
+    def evaluate(self, dataset, batch_size=256):
+        """
+        streams a dataset through the network in batches and accumulates the loss and the accuracy of all samples in
+        the graph. Validation and test set share one compiled evaluation function.
+        :param dataset: tf.data.Dataset of (x, y) batches, or a tuple (x, y) of arrays, which is split into batches
+        :param batch_size: batch size, if dataset is a tuple
+        :return: mean loss and accuracy over all samples
+        """
+        if not isinstance(dataset, tf.data.Dataset):
+            dataset = tf.data.Dataset.from_tensor_slices(dataset).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+        self.eval_loss_metric.reset_state()
+        self.eval_acc_metric.reset_state()
+        self.evaluate_batches(dataset)
+        return float(self.eval_loss_metric.result()), float(self.eval_acc_metric.result())
+
+    @tf.function
+    def evaluate_batches(self, dataset):
+        for x, y in dataset:
+            out = tf.keras.activations.softmax(self(x, training=False))
+            self.eval_loss_metric.update_state(keras.losses.sparse_categorical_crossentropy(y, out))
+            self.eval_acc_metric.update_state(y, out)
+        return 0
+
+    def save(self, folder_name, writer=None):
+        """
+        :param writer: optional checkpoint.CheckpointWriter, that writes the file in the background
+        """
+        arrays = {}
+        arrays.update(self.layer1.get_arrays(layer_id=0))
+        arrays.update(self.layer2.get_arrays(layer_id=1))
+        arrays.update(self.layer3.get_arrays(layer_id=2))
+        arrays.update(self.layer4.get_arrays(layer_id=3))
+        arrays.update(self.layer5.get_arrays(layer_id=4))
+        file_name = path.join(folder_name, CHECKPOINT_FILE)
+        if writer is None:
+            write_checkpoint(file_name, arrays)
+        else:
+            writer.write(file_name, arrays)
+        return 0
+
+    def load(self, folder_name):
+        arrays = load_arrays(folder_name)
+        self.layer1.set_arrays(arrays, layer_id=0)
+        self.layer2.set_arrays(arrays, layer_id=1)
+        self.layer3.set_arrays(arrays, layer_id=2)
+        self.layer4.set_arrays(arrays, layer_id=3)
+        self.layer5.set_arrays(arrays, layer_id=4)
+        return 0
 
 
 # ------ utils below
 
+def truncation_rank(d, tol, criterion="relative"):
+    """
+    finds the rank for truncating a spectrum in one vectorized pass, so it can be used inside a graph. For the
+    absolute and relative criterion, this is the smallest j with ||d[j:2 * rmax - 1]|| < tol, rmax = len(d) // 2,
+    or rmax if there is none.
+    :param d: singular values in descending order
+    :param tol: absolute: threshold for the norm of the truncated tail, relative: threshold for the norm of the
+                truncated tail relative to ||d||, budget: number of singular values to keep
+    :param criterion: "absolute", "relative" or "budget"
+    :return: new rank (int32 tensor)
+    """
+    if criterion == "budget":
+        return tf.minimum(tf.cast(tol, tf.int32), tf.shape(d)[0])
+    if criterion == "relative":
+        tol = tol * tf.linalg.norm(d)
+    elif criterion != "absolute":
+        raise ValueError("Unknown truncation criterion: " + str(criterion))
+
+    rmax = tf.shape(d)[0] // 2
+    n_tail = tf.maximum(2 * rmax - 1, 0)
+    # norms of all tails d[j:n_tail] at once
+    tail = tf.sqrt(tf.math.cumsum(tf.square(d[:n_tail]), reverse=True))
+    n_below = tf.reduce_sum(tf.cast(tail < tol, tf.int32))  # tail is non-increasing, so these are the last ones
+    return tf.where(n_below > 0, n_tail - n_below, rmax)
+
+
+def allocate_ranks(spectra, costs, budget, max_ranks, min_rank=2):
+    """
+    distributes a budget over the ranks of several layers, greedily in one vectorized pass, so it can be used inside
+    a graph: the singular values of all layers are kept in the order of their relative energy d_i^2 / ||d||^2 per
+    cost, until the next one exceeds the budget. The spectra are sorted, so every layer keeps its leading singular
+    values. The first min_rank of each layer are always kept.
+    :param spectra: list with the singular values of each layer, in descending order
+    :param costs: list with the cost of one rank of each layer
+    :param budget: total cost of the ranks of all layers
+    :param max_ranks: list with the largest rank of each layer
+    :return: list with the new rank of each layer (int32 tensors)
+    """
+    scores = []
+    layer_costs = []
+    layer_ids = []
+    for i, d in enumerate(spectra):
+        position = tf.range(tf.shape(d)[0])
+        energy = tf.square(d) / tf.maximum(tf.reduce_sum(tf.square(d)), np.finfo(np.float32).tiny)
+        score = tf.where(position < min_rank, np.inf, energy / costs[i])
+        scores.append(tf.where(position < max_ranks[i], score, -np.inf))
+        layer_costs.append(tf.fill(tf.shape(d), tf.cast(costs[i], tf.float32)))
+        layer_ids.append(tf.fill(tf.shape(d), i))
+    scores = tf.concat(scores, axis=0)
+    order = tf.argsort(scores, direction="DESCENDING", stable=True)
+    scores = tf.gather(scores, order)
+    spent = tf.math.cumsum(tf.gather(tf.concat(layer_costs, axis=0), order))
+    keep = tf.logical_or(tf.logical_and(spent <= budget, scores > -np.inf), scores == np.inf)
+    ranks = tf.math.unsorted_segment_sum(tf.cast(keep, tf.int32), tf.gather(tf.concat(layer_ids, axis=0), order),
+                                         num_segments=len(spectra))
+    return tf.unstack(ranks, num=len(spectra))
+
+
+def low_rank_inference_layers(us, vt, b, activation=None):
+    """
+    builds keras layers that evaluate activation(x @ us @ vt + b). The factors stay separate, if that needs fewer
+    flops per sample than the merged matrix, i.e. if rank * (input_dim + units) <= input_dim * units.
+    :param us: left factor with S folded in (input_dim x rank)
+    :param vt: right factor (rank x units), or None for a dense weight matrix us
+    :param b: bias (units)
+    :param activation: activation of the layer
+    :return: list of keras layers
+    """
+    input_dim, rank = us.shape
+    if vt is not None and rank * (input_dim + vt.shape[1]) > input_dim * vt.shape[1]:
+        us = np.matmul(us, vt)
+        vt = None
+
+    if vt is None:
+        dense = keras.layers.Dense(us.shape[1], activation=activation)
+        dense.build((None, input_dim))
+        dense.set_weights([us, b])
+        return [dense]
+
+    projection = keras.layers.Dense(rank, use_bias=False)
+    projection.build((None, input_dim))
+    projection.set_weights([us])
+    dense = keras.layers.Dense(vt.shape[1], activation=activation)
+    dense.build((None, rank))
+    dense.set_weights([vt, b])
+    return [projection, dense]
+
+
+def assign_padded(variable, value):
+    """
+    writes value into the leading block of variable and zeros the rest
+    :param variable: preallocated 2d variable
+    :param value: 2d tensor, not larger than variable in any dimension
+    :return: assign op
+    """
+    value = tf.convert_to_tensor(value, dtype=variable.dtype)
+    padding = [[0, variable.shape[0] - tf.shape(value)[0]], [0, variable.shape[1] - tf.shape(value)[1]]]
+    return variable.assign(tf.pad(value, padding))
+
+
+def randomized_svd(w, rank, oversampling=10, power_iterations=2, seed=None):
+    """
+    truncated svd with a randomized range finder (Halko, Martinsson, Tropp 2011). Costs O(m n (rank + oversampling))
+    instead of O(m n min(m, n)) for the full svd.
+    :param w: matrix (m x n)
+    :param rank: number of singular triplets
+    :param oversampling: additional samples of the range of w, improves the accuracy of the trailing triplets
+    :param power_iterations: number of subspace iterations with w w^T, needed if the spectrum decays slowly
+    :param seed: seed of the random test matrix
+    :return: d, u, v like tf.linalg.svd, but only the leading rank singular values and vectors
+    """
+    w = tf.convert_to_tensor(w, dtype=tf.float32)
+    n_samples = min(rank + oversampling, w.shape[0], w.shape[1])
+    omega = tf.random.normal((w.shape[1], n_samples), seed=seed)
+    q, _ = tf.linalg.qr(tf.matmul(w, omega))
+    for i in range(power_iterations):
+        # re-orthonormalize after each product, otherwise the small singular directions are lost in round-off
+        q, _ = tf.linalg.qr(tf.matmul(w, q, transpose_a=True))
+        q, _ = tf.linalg.qr(tf.matmul(w, q))
+    d, u_b, v = tf.linalg.svd(tf.matmul(q, w, transpose_a=True))
+    return d[:rank], tf.matmul(q, u_b[:, :rank]), v[:, :rank]
+
+
+def group_by_shape(layers):
+    """
+    :param layers: dlra layers
+    :return: list of groups (lists) of layers with equally shaped variables, whose factorizations can be batched
+    """
+    groups = {}
+    for layer in layers:
+        key = (tuple(layer.k.shape), tuple(layer.l_t.shape), tuple(layer.s.shape))
+        groups.setdefault(key, []).append(layer)
+    return list(groups.values())
+
+
+def batched_qr(matrices, ranks):
+    """
+    orthonormal bases of the leading ranks[i] columns of equally shaped matrices, in one batched QR decomposition.
+    The remaining columns are set to zero. This leaves the leading columns of Q unchanged, since Householder QR
+    processes the columns in order.
+    :param matrices: list of matrices (n x m) with equal shape
+    :param ranks: list with the number of leading columns of each matrix
+    :return: list of bases with min(n, ranks[i]) columns
+    """
+    a = tf.stack(matrices)
+    mask = tf.range(tf.shape(a)[2])[tf.newaxis, :] < tf.stack(ranks)[:, tf.newaxis]
+    q, _ = tf.linalg.qr(tf.where(mask[:, tf.newaxis, :], a, tf.zeros_like(a)))
+    return [q[i, :, :ranks[i]] for i in range(len(matrices))]
+
+
+def batched_augmented_qr(k, u, ranks):
+    """
+    orthonormal bases of [k[i][:, :r] | u[i][:, :r]], r = ranks[i], for equally shaped k[i] and u[i] where the
+    columns of u[i][:, :r] are orthonormal. The basis is [u[i][:, :r] | q], with q an orthonormal basis of the part of
+    k[i][:, :r] orthogonal to u[i][:, :r]. So the batched QR only runs over the r new columns and
+    N = basis^T u[i][:, :r] is [I; 0] without a matrix product. The projection is applied twice, which keeps q
+    orthogonal to u in floating point. If 2r exceeds the dimension or a residual is numerically rank deficient, the
+    bases fall back to the QR decomposition of [k | u], see batched_qr.
+    :return: list of (basis with min(n, 2 ranks[i]) columns, N = basis^T u[i][:, :r])
+    """
+    a = tf.stack(k)
+    b = tf.stack(u)
+    mask = (tf.range(tf.shape(a)[2])[tf.newaxis, :] < tf.stack(ranks)[:, tf.newaxis])[:, tf.newaxis, :]
+    a = tf.where(mask, a, tf.zeros_like(a))
+    b = tf.where(mask, b, tf.zeros_like(b))
+    residual = a
+    for _ in range(2):
+        residual = residual - tf.matmul(b, tf.matmul(b, residual, transpose_a=True))
+    q, r_factor = tf.linalg.qr(residual)
+    # |diag(R)| is the norm of each residual column after removing the previous ones
+    tol = 10 * np.finfo(a.dtype.as_numpy_dtype).eps * tf.cast(tf.shape(a)[1], a.dtype) * tf.norm(a, axis=[1, 2])
+    independent = tf.reduce_all(tf.logical_or(tf.abs(tf.linalg.diag_part(r_factor)) > tol[:, tf.newaxis],
+                                              tf.logical_not(mask[:, 0, :])))
+    fits = 2 * tf.reduce_max(ranks) <= tf.shape(a)[1]
+
+    def projected():
+        return [(tf.concat((u_i[:, :r], q[i, :, :r]), axis=1), tf.eye(2 * r, r, dtype=a.dtype))
+                for i, (u_i, r) in enumerate(zip(u, ranks))]
+
+    def concatenated():
+        matrices = []
+        for k_i, u_i, r in zip(k, u, ranks):
+            # active columns first
+            matrices.append(tf.concat((k_i[:, :r], u_i[:, :r], k_i[:, r:], u_i[:, r:]), axis=1))
+        bases = batched_qr(matrices, [2 * r for r in ranks])
+        return [(basis, tf.matmul(basis, u_i[:, :r], transpose_a=True)) for basis, u_i, r in zip(bases, u, ranks)]
+
+    return tf.cond(tf.logical_and(fits, independent), projected, concatenated)
+
+
+def augmented_basis(k, u):
+    """
+    orthonormal basis of [k | u] for a matrix u with orthonormal columns, see batched_augmented_qr
+    :param k: matrix (n x r)
+    :param u: orthonormal basis (n x r)
+    :return: basis with min(n, 2r) columns, N = basis^T u
+    """
+    rank = k.shape[1] if k.shape[1] is not None else tf.shape(k)[1]
+    return batched_augmented_qr([k], [u], [rank])[0]
+
+
+def batched_svd(matrices, row_ranks, col_ranks):
+    """
+    svds of the leading (row_ranks[i] x col_ranks[i]) blocks of equally shaped matrices, in one batched call. The
+    remaining entries are set to zero, which only adds zero singular values at the end of the spectrum.
+    :param matrices: list of matrices with equal shape
+    :param row_ranks: list with the number of leading rows of each matrix
+    :param col_ranks: list with the number of leading columns of each matrix
+    :return: list of (d, u, v) like tf.linalg.svd of the leading blocks
+    """
+    a = tf.stack(matrices)
+    row_ranks = tf.stack(row_ranks)
+    col_ranks = tf.stack(col_ranks)
+    rows = tf.range(tf.shape(a)[1])[tf.newaxis, :, tf.newaxis] < row_ranks[:, tf.newaxis, tf.newaxis]
+    cols = tf.range(tf.shape(a)[2])[tf.newaxis, tf.newaxis, :] < col_ranks[:, tf.newaxis, tf.newaxis]
+    d, u, v = tf.linalg.svd(tf.where(tf.logical_and(rows, cols), a, tf.zeros_like(a)))
+    return [(d[i, :tf.minimum(row_ranks[i], col_ranks[i])], u[i, :row_ranks[i], :], v[i, :col_ranks[i], :])
+            for i in range(len(matrices))]
+
+
+def compact_arrays(u, s, vt, b, layer_id):
+    """
+    collects the factors needed to resume training of a dlra layer. k = U S and l_t = S Vt are recomputed on load,
+    the remaining auxiliary variables only carry values between the sub steps of a training step.
+    :param u: basis U (input_dim x rank)
+    :param s: coefficient matrix S (rank x rank), see compact_coefficients
+    :param vt: basis Vt (rank x units)
+    :param b: bias (units)
+    :param layer_id: index of the layer in the network
+    :return: dict name -> tensor
+    """
+    return {"aux_U" + str(layer_id): u, "s" + str(layer_id): s, "aux_Vt" + str(layer_id): vt, "b" + str(layer_id): b}
+
+
+def compact_coefficients(arrays):
+    """
+    replaces every coefficient matrix "s<layer_id>" that is diagonal, e.g. after rank adaption, by its diagonal
+    "sigma<layer_id>". The test runs on numpy arrays, so save() passes it to the CheckpointWriter thread instead of
+    waiting for the device in the training loop.
+    :param arrays: dict name -> tensor or numpy array, as returned by compact_arrays
+    :return: dict name -> numpy array
+    """
+    compacted = {}
+    for name, value in arrays.items():
+        value = np.asarray(value)
+        if name[0] == "s" and name[1:].isdigit() and np.array_equal(value, np.diag(np.diagonal(value))):
+            compacted["sigma" + name[1:]] = np.diagonal(value)
+        else:
+            compacted[name] = value
+    return compacted
+
+
+def expand_arrays(arrays, layer_id):
+    """
+    :param arrays: dict name -> numpy array of a full or compact checkpoint
+    :param layer_id: index of the layer in the network
+    :return: S, k and l_t of the layer, computed from the factors if the checkpoint is compact
+    """
+    if "s" + str(layer_id) in arrays:
+        s = arrays["s" + str(layer_id)]
+    else:
+        s = np.diag(arrays["sigma" + str(layer_id)])
+    k = arrays.get("k" + str(layer_id))
+    if k is None:
+        k = arrays["aux_U" + str(layer_id)] @ s
+    l_t = arrays.get("l_t" + str(layer_id))
+    if l_t is None:
+        l_t = s @ arrays["aux_Vt" + str(layer_id)]
+    return s, k, l_t
+
+
+def fused_kl_matmul(inputs, k, vt, u, l_t):
+    """
+    evaluates the k-branch (inputs @ k @ vt) and the l-branch (inputs @ u @ l_t) of a layer in one pass. Like
+    matmul_chain, the chains are evaluated in the order with the fewest flops: left to right, or with the
+    pre-multiplied weights k vt and u l_t if the batch is small compared to the rank.
+    :param inputs: layer input, either shared by both branches (batch x input_dim) or stacked (2 x batch x input_dim)
+    :return: outputs of the k- and l-branch, stacked (2 x batch x units)
+    """
+
+    def left_to_right():
+        if inputs.shape.rank == 2:
+            # both branches see the same activations, so k and u share one matmul
+            z = tf.matmul(inputs, tf.concat((k, u), axis=1))
+            z = tf.stack(tf.split(z, 2, axis=1))
+        else:
+            z = tf.matmul(inputs, tf.stack((k, u)))
+        return tf.matmul(z, tf.stack((vt, l_t)))
+
+    def merged():
+        weights = tf.matmul(tf.stack((k, u)), tf.stack((vt, l_t)))
+        if inputs.shape.rank == 2:
+            z = tf.matmul(inputs, tf.concat(tf.unstack(weights), axis=1))
+            return tf.stack(tf.split(z, 2, axis=1))
+        return tf.matmul(inputs, weights)
+
+    dims = [inputs.shape[-2], k.shape[0], k.shape[1], vt.shape[1]]
+    if None not in dims:
+        return left_to_right() if contraction_order(tuple(dims)) == ((0, 1), 2) else merged()
+    dims = [tf.shape(inputs, out_type=tf.int64)[-2], tf.shape(k, out_type=tf.int64)[0],
+            tf.shape(k, out_type=tf.int64)[1], tf.shape(vt, out_type=tf.int64)[1]]
+    # ties are evaluated left to right, as in contraction_order
+    return tf.cond(order_flops(((0, 1), 2), dims) <= order_flops((0, (1, 2)), dims), left_to_right, merged)
+
+
+def matmul_chain(*matrices):
+    """
+    product of a chain of matrices, in the order with the fewest flops. Left to right is only optimal if the batch
+    is larger than the ranks, e.g. for small inference batches pre-multiplying the factors is cheaper. With static
+    shapes the order is chosen while tracing (contraction_order, cached per shape), otherwise (unknown batch size,
+    ranks of the adaptive layers) the costs of all orders are compared in the graph and only the cheapest is
+    evaluated.
+    :param matrices: 2d tensors with matching inner dimensions
+    :return: matrices[0] @ matrices[1] @ ... @ matrices[-1]
+    """
+    dims = [matrix.shape[0] for matrix in matrices] + [matrices[-1].shape[1]]
+    if None not in dims:
+        return evaluate_order(contraction_order(tuple(dims)), matrices)
+    dims = [tf.shape(matrix, out_type=tf.int64)[0] for matrix in matrices] + [
+        tf.shape(matrices[-1], out_type=tf.int64)[1]]
+    orders = contraction_orders(0, len(matrices) - 1)
+    if len(orders) == 1:
+        return evaluate_order(orders[0], matrices)
+    costs = tf.stack([order_flops(order, dims) for order in orders])
+    return tf.switch_case(tf.argmin(costs, output_type=tf.int32),
+                          [lambda order=order: evaluate_order(order, matrices) for order in orders])
+
+
+@lru_cache(maxsize=None)
+def contraction_order(dims):
+    """
+    matrix chain ordering by dynamic programming
+    :param dims: tuple with the n + 1 dimensions of a chain of n matrices, matrix i is (dims[i] x dims[i + 1])
+    :return: order with the fewest flops, as nested tuples of matrix indices, e.g. (0, (1, 2))
+    """
+    n = len(dims) - 1
+    cost = {(i, i): 0 for i in range(n)}
+    order = {(i, i): i for i in range(n)}
+    for length in range(2, n + 1):
+        for i in range(n - length + 1):
+            j = i + length - 1
+            # ties are split as far right as possible, i.e. left to right
+            split = min(reversed(range(i, j)), key=lambda k: cost[i, k] + cost[k + 1, j] + dims[i] * dims[k + 1] *
+                        dims[j + 1])
+            cost[i, j] = cost[i, split] + cost[split + 1, j] + dims[i] * dims[split + 1] * dims[j + 1]
+            order[i, j] = (order[i, split], order[split + 1, j])
+    return order[0, n - 1]
+
+
+@lru_cache(maxsize=None)
+def contraction_orders(i, j):
+    """
+    :return: all orders of the product of the matrices i, ..., j, as nested tuples of matrix indices
+    """
+    if i == j:
+        return (i,)
+    return tuple((left, right) for k in range(i, j) for left in contraction_orders(i, k)
+                 for right in contraction_orders(k + 1, j))
+
+
+def order_flops(order, dims):
+    """
+    :param order: nested tuples of matrix indices, see contraction_order
+    :param dims: dimensions of the chain, see contraction_order
+    :return: multiply-adds of the products in order
+    """
+    if not isinstance(order, tuple):
+        return 0
+    first, last = first_and_last(order)
+    split = first_and_last(order[0])[1]
+    return order_flops(order[0], dims) + order_flops(order[1], dims) + dims[first] * dims[split + 1] * dims[last + 1]
+
+
+def first_and_last(order):
+    if not isinstance(order, tuple):
+        return order, order
+    return first_and_last(order[0])[0], first_and_last(order[1])[1]
+
+
+def evaluate_order(order, matrices):
+    if not isinstance(order, tuple):
+        return matrices[order]
+    return tf.matmul(evaluate_order(order[0], matrices), evaluate_order(order[1], matrices))
+
+
+def step_flops(n, m, r, r_u, r_v, batch_size, adapt=False):
+    """
+    floating point operations of one training step of a dlra layer (input_dim n, units m), counting a multiply-add
+    as 2 flops and the backward pass of a tape as twice its forward pass. QR and SVD are counted by the leading terms
+    of Householder QR with explicit Q and of the Golub-Reinsch SVD with both singular vector matrices.
+    :param r: rank
+    :param r_u: columns of the basis after the K step (2r, if augmented)
+    :param r_v: columns of the basis after the L step (2r, if augmented)
+    :param adapt: count the rank adaption
+    :return: dict phase -> flops
+    """
+
+    def qr(rows, cols):
+        return 4 * rows * cols ** 2 - 4 * cols ** 3 // 3
+
+    def svd(rows, cols):
+        rows, cols = max(rows, cols), min(rows, cols)
+        return 4 * rows ** 2 * cols + 8 * rows * cols ** 2 + 9 * cols ** 3
+
+    return {"kl_preprocessing": 2 * (n + m) * r * r,
+            # k- and l-branch: inputs @ [k | u], then @ vt and @ l_t
+            "kl_tape": 3 * 4 * batch_size * r * (n + m),
+            "qr_postprocessing": qr(n, r_u) + qr(m, r_v),
+            "s_preprocessing": 2 * r_u * r * r + 2 * r_u * r * r_v,
+            "s_tape": 3 * 2 * batch_size * (n * r_u + r_u * r_v + r_v * m),
+            "rank_adaption": svd(r_u, r_v) + 2 * (n + m) * r_u * r if adapt else 0}
+
+
+def cast_factors(dtype, *factors):
+    """
+    :param dtype: compute dtype of the layer
+    :param factors: variables or tensors
+    :return: list of the factors in dtype. The cast is differentiable, so the gradients reach the float32 variables
+    """
+    return [tf.cast(factor, dtype) for factor in factors]
+
+
+def get_scaled_loss(optimizer, loss):
+    """
+    :return: the loss scaled by the loss scale of a keras.mixed_precision.LossScaleOptimizer, else the loss
+    """
+    if isinstance(optimizer, keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_scaled_loss(loss)
+    return loss
+
+
+def get_unscaled_gradients(optimizer, grads):
+    """
+    :return: the gradients of a scaled loss divided by the loss scale, see get_scaled_loss
+    """
+    if isinstance(optimizer, keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_unscaled_gradients(grads)
+    return grads
+
+
+def build_optimizer(optimizer, variables):
+    """
+    the keras optimizers (not the legacy ones) create their slots only for the variables of the first
+    apply_gradients. The K-, L- and S-step update different variables, so the optimizer is built for all of them.
+    Both these optimizers and DLRAOptimizer skip the build once they are built, e.g. in every eager profiled step.
+    :param variables: all variables trained by the optimizer
+    """
+    if hasattr(optimizer, "build") and not getattr(optimizer, "built", False):
+        optimizer.build(variables)
+    return 0
+
+
 def create_csv_logger_cb(folder_name: str):
     '''
     dynamically creates a csvlogger and tensorboard logger
@@ -0,0 +1,226 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from optparse import OptionParser
+
+import numpy as np
+
+from checkpoint import load_arrays
+
+
+def load_factors(folder_name: str, dtype=np.float32):
+    '''
+    reads the layers of a model saved by DLRANet.save or DLRANetAdaptive.save (full or compact) and folds S into the
+    left factor. A layer keeps the two factors U S and Vt, if x @ (U S) @ Vt needs fewer flops per sample than the
+    merged matrix, i.e. if rank * (input_dim + units) <= input_dim * units, see low_rank_inference_layers.
+    :param folder_name: model folder with the checkpoint file (or the .npy files of older checkpoints)
+    :return: list of (us, vt, b) of the low-rank layers, vt is None for merged layers, and (w, b) of the output layer
+    '''
+    arrays = load_arrays(folder_name)
+    layers = []
+    layer_id = 0
+    while "aux_U" + str(layer_id) in arrays:
+        if "s" + str(layer_id) in arrays:
+            s = np.asarray(arrays["s" + str(layer_id)])
+        else:
+            s = np.diag(arrays["sigma" + str(layer_id)])
+        us = np.asarray(arrays["aux_U" + str(layer_id)]) @ s
+        vt = np.asarray(arrays["aux_Vt" + str(layer_id)])
+        input_dim, rank = us.shape
+        if rank * (input_dim + vt.shape[1]) > input_dim * vt.shape[1]:
+            us = us @ vt
+            vt = None
+        layers.append((us.astype(dtype), None if vt is None else vt.astype(dtype),
+                       np.asarray(arrays["b" + str(layer_id)], dtype=dtype)))
+        layer_id += 1
+    if layer_id == 0:
+        raise ValueError(folder_name + " contains no DLRA checkpoint")
+    output = (np.asarray(arrays["w_" + str(layer_id)], dtype=dtype), np.asarray(arrays["b_" + str(layer_id)],
+                                                                               dtype=dtype))
+    return layers, output
+
+
+class InferenceEngine:
+    '''
+    serves a saved DLRA network from numpy, without tensorflow. Concurrent requests are queued and a batching thread
+    groups them into micro batches: it waits at most max_delay seconds after the first request of a batch for more
+    requests, or until max_batch_size samples are collected. The batches are evaluated by a pool of worker threads
+    (numpy releases the GIL in the matmuls), so a batch is evaluated while the next one is collected.
+    '''
+
+    def __init__(self, folder_name: str, max_batch_size=64, max_delay=0.002, num_workers=2, dtype=np.float32):
+        '''
+        :param folder_name: model folder, see load_factors
+        :param max_batch_size: samples per micro batch
+        :param max_delay: seconds a request waits at most for other requests to batch with
+        :param num_workers: number of threads that evaluate batches
+        '''
+        self.layers, self.output = load_factors(folder_name, dtype=dtype)
+        self.input_dim = self.layers[0][0].shape[0]
+        self.dtype = dtype
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="inference_worker")
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.thread = threading.Thread(target=self.run, name="inference_batcher", daemon=True)
+        self.thread.start()
+
+    def forward(self, x):
+        '''
+        :param x: batch of inputs (batch x input_dim)
+        :return: softmax output of the network
+        '''
+        for us, vt, b in self.layers:
+            x = x @ us
+            if vt is not None:
+                x = x @ vt
+            x += b
+            np.maximum(x, 0, out=x)
+        x = x @ self.output[0] + self.output[1]
+        x = np.exp(x - x.max(axis=1, keepdims=True))
+        return x / x.sum(axis=1, keepdims=True)
+
+    def flops_per_sample(self):
+        '''
+        :return: multiply-add flops of one sample through all layers
+        '''
+        flops = 2 * self.output[0].size
+        for us, vt, _ in self.layers:
+            flops += 2 * us.size + (0 if vt is None else 2 * vt.size)
+        return flops
+
+    def submit(self, x):
+        '''
+        queues a request, returns immediately
+        :param x: one input (input_dim) or a batch of inputs (samples x input_dim)
+        :return: concurrent.futures.Future of the softmax output (samples x output_dim)
+        '''
+        x = np.atleast_2d(np.asarray(x, dtype=self.dtype))
+        future = Future()
+        self.requests.put((x, future, time.perf_counter()))
+        return future
+
+    def predict(self, x, timeout=None):
+        '''
+        :param x: one input (input_dim) or a batch of inputs (samples x input_dim)
+        :return: softmax output, (output_dim) for one input
+        '''
+        out = self.submit(x).result(timeout=timeout)
+        return out[0] if np.ndim(x) == 1 else out
+
+    def run(self):
+        closed = False
+        while not closed:
+            item = self.requests.get()
+            if item is None:
+                break
+            batch = [item]
+            samples = len(item[0])
+            deadline = item[2] + self.max_delay
+            while samples < self.max_batch_size:
+                try:
+                    item = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+                samples += len(item[0])
+            self.pool.submit(self.run_batch, batch)
+
+    def run_batch(self, batch):
+        try:
+            out = self.forward(np.concatenate([x for x, _, _ in batch]))
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return 0
+        end = time.perf_counter()
+        offset = 0
+        for x, future, _ in batch:
+            future.set_result(out[offset:offset + len(x)])
+            offset += len(x)
+        with self.lock:
+            self.latencies.extend(end - start for _, _, start in batch)
+            self.samples += offset
+            self.batches += 1
+        return 0
+
+    def reset_stats(self):
+        with self.lock:
+            self.latencies = []
+            self.samples = 0
+            self.batches = 0
+            self.start_time = time.perf_counter()
+        return 0
+
+    def stats(self):
+        '''
+        :return: dict with the number of requests, samples and batches since reset_stats(), the mean batch size, the
+                 p50 and p99 latency of the requests in ms (queueing, batching and evaluation), the throughput in
+                 requests and samples per second and the flops per sample
+        '''
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            samples, batches = self.samples, self.batches
+            elapsed = time.perf_counter() - self.start_time
+        return {"requests": len(latencies), "samples": samples, "batches": batches,
+                "mean_batch_size": samples / max(batches, 1),
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "requests_per_s": len(latencies) / elapsed, "samples_per_s": samples / elapsed,
+                "flops_per_sample": self.flops_per_sample()}
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+        self.pool.shutdown(wait=True)
+        return 0
+
+
+def run_load(engine, clients, requests_per_client, seed=0):
+    '''
+    closed loop load test: every client thread sends single sample requests one after the other
+    :param engine: InferenceEngine
+    :param clients: number of concurrent clients
+    :param requests_per_client: requests of each client
+    :return: engine.stats() of the load test
+    '''
+    inputs = np.random.default_rng(seed).random((requests_per_client, engine.input_dim), dtype=np.float32)
+
+    def client():
+        for x in inputs:
+            engine.predict(x)
+
+    # warm up
+    for x in inputs[:10]:
+        engine.predict(x)
+    engine.reset_stats()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return engine.stats()
+
+
+if __name__ == '__main__':
+    # --- parse options ---
+    parser = OptionParser()
+    parser.add_option("-m", "--model", dest="model", default="e2edense_sr10_v0.1/best_model")
+    parser.add_option("-b", "--max_batch_size", dest="max_batch_size", default=64)
+    parser.add_option("-d", "--max_delay", dest="max_delay", default=2)  # in ms
+    parser.add_option("-w", "--workers", dest="workers", default=2)
+    parser.add_option("-c", "--clients", dest="clients", default=32)
+    parser.add_option("-n", "--requests", dest="requests", default=1000)  # per client
+
+    (options, args) = parser.parse_args()
+    engine = InferenceEngine(options.model, max_batch_size=int(options.max_batch_size),
+                             max_delay=float(options.max_delay) / 1000, num_workers=int(options.workers))
+    print(json.dumps(run_load(engine, clients=int(options.clients), requests_per_client=int(options.requests))))
+    engine.close()
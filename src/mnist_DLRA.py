@@ -1,13 +1,17 @@
 from dlranet import DLRANetAdaptive, create_csv_logger_cb
+from checkpoint import CheckpointWriter
+from dlra_optimizer import DLRAOptimizer
+from dataset import mnist_datasets
+from profiling import PhaseTimer, profile_file_name
 
 import tensorflow as tf
 from tensorflow import keras
-import numpy as np
 from optparse import OptionParser
 from os import path, makedirs
 
 
-def train(start_rank, tolerance, load_model, dim_layer):
+def train(start_rank, tolerance, load_model, dim_layer, adapt_every=1, precision="float32", profile=0,
+          rank_budget=None, budget_unit="rank", adapt_trigger=None, seed=None):
     # specify training
     epochs = 10
     batch_size = 256
@@ -34,43 +38,35 @@ def train(start_rank, tolerance, load_model, dim_layer):
     max_rank = 350  # maximum rank of S matrix
 
     dlra_layer_dim = dim_layer
+    if seed is not None:
+        tf.keras.utils.set_random_seed(seed)
 
     model = DLRANetAdaptive(input_dim=input_dim, output_dim=output_dim, low_rank=starting_rank,
-                            dlra_layer_dim=dlra_layer_dim, tol=tol, rmax_total=max_rank)
+                            dlra_layer_dim=dlra_layer_dim, tol=tol, rmax_total=max_rank, adapt_every=adapt_every,
+                            adapt_trigger=adapt_trigger, dtype_policy=precision, rank_budget=rank_budget,
+                            budget_unit=budget_unit)
     # Build optimizer
     optimizer = tf.keras.optimizers.Adam(learning_rate=1e-3)
-    # Choose loss
-    loss_fn = keras.losses.SparseCategoricalCrossentropy(from_logits=False)
-    # Choose metrics (to monitor training, but not to optimize on)
-    loss_metric = tf.keras.metrics.Mean()
-    acc_metric = tf.keras.metrics.Accuracy()
-    loss_metric_acc_val = tf.keras.metrics.Accuracy()
-
-    # Build dataset
-    (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-    x_train = np.reshape(x_train, (-1, input_dim))
-    x_test = np.reshape(x_test, (-1, input_dim))
-
-    # Reserve 10,000 samples for validation.
-    val_size = 10000
-    x_val = x_train[-val_size:]
-    y_val = y_train[-val_size:]
-    (x_val, y_val) = normalize_img(x_val, y_val)
-
-    x_train = x_train[:-val_size]
-    y_train = y_train[:-val_size]
-    (x_train, y_train) = normalize_img(x_train, y_train)
-
-    (x_test, y_test) = normalize_img(x_test, y_test)
-    # Prepare the training dataset.
-    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    train_dataset = train_dataset.shuffle(buffer_size=1024).batch(batch_size)
+    if precision == "mixed_float16":
+        # float16 gradients underflow without loss scaling, which needs a single optimizer for all sub steps
+        optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+        tf.get_logger().warning("mixed_float16: the K-, L- and S-step share one Adam state, which does not follow "
+                                "the bases of the integrator")
+    else:
+        # separate Adam states for the K-, L- and S-step, which follow the bases of the integrator
+        optimizer = DLRAOptimizer(model, optimizer)
+
+    # Build dataset, the training batches are shuffled, normalized and prefetched by the input pipeline. With a seed,
+    # the weights and the order of the batches are the same in every run
+    train_dataset, val_dataset, test_dataset = mnist_datasets(batch_size=batch_size, seed=seed,
+                                                              deterministic=seed is not None)
 
     # Create logger
     log_file, file_name = create_csv_logger_cb(folder_name=filename)
 
     # print headline
-    log_string = "loss_train;acc_train;loss_val;acc_val;loss_test;acc_test;rank1;rank2;rank3;rank4\n"
+    log_string = "loss_train;acc_train;loss_val;acc_val;loss_test;acc_test;" + ";".join(
+        "rank" + str(i + 1) for i in range(len(model.dlra_layers))) + "\n"
     with open(file_name, "a") as log:
         log.write(log_string)
 
@@ -78,128 +74,46 @@ def train(start_rank, tolerance, load_model, dim_layer):
     if load_model == 1:
         model.load(folder_name=folder_name)
 
+    # checkpoints are written in the background, keeping the last 3 of each folder
+    checkpoint_writer = CheckpointWriter(keep_last=3)
     best_acc = 0
     best_loss = 10
+    # profiling: 0 off, 1 time the phases of every step, 2 also record a tf.profiler trace of the first epoch
+    timer = PhaseTimer(trace=profile == 2) if profile > 0 else None
     # Iterate over epochs. (Training loop)
     for epoch in range(epochs):
         print("Start of epoch %d" % (epoch,))
+        model.reset_train_metrics()
+        if profile == 2 and epoch == 0:
+            tf.profiler.experimental.start(filename + "/profile")
         # Iterate over the batches of the dataset.
 
         for step, batch_train in enumerate(train_dataset):
-            # 1.a) K and L Step Preproccessing
-            model.dlraBlockInput.k_step_preprocessing()
-            model.dlraBlockInput.l_step_preprocessing()
-            model.dlraBlock1.k_step_preprocessing()
-            model.dlraBlock1.l_step_preprocessing()
-            model.dlraBlock2.k_step_preprocessing()
-            model.dlraBlock2.l_step_preprocessing()
-            model.dlraBlock3.k_step_preprocessing()
-            model.dlraBlock3.l_step_preprocessing()
-
-            # 1.b) Tape Gradients for K-Step
-            model.toggle_non_s_step_training()
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=0, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            grads_k_step = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_k_step, model.trainable_weights)
-            model.set_dlra_bias_grads_to_zero(grads_k_step)
-
-            # 1.b) Tape Gradients for L-Step
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=1, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            grads_l_step = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_l_step, model.trainable_weights)
-            model.set_dlra_bias_grads_to_zero(grads_l_step)
-
-            # Gradient update for K and L
-            optimizer.apply_gradients(zip(grads_k_step, model.trainable_weights))
-            optimizer.apply_gradients(zip(grads_l_step, model.trainable_weights))
-
-            # Postprocessing K and L
-            model.dlraBlockInput.k_step_postprocessing_adapt()
-            model.dlraBlockInput.l_step_postprocessing_adapt()
-            model.dlraBlock1.k_step_postprocessing_adapt()
-            model.dlraBlock1.l_step_postprocessing_adapt()
-            model.dlraBlock2.k_step_postprocessing_adapt()
-            model.dlraBlock2.l_step_postprocessing_adapt()
-            model.dlraBlock3.k_step_postprocessing_adapt()
-            model.dlraBlock3.l_step_postprocessing_adapt()
-
-            # S-Step Preprocessing
-            model.dlraBlockInput.s_step_preprocessing()
-            model.dlraBlock1.s_step_preprocessing()
-            model.dlraBlock2.s_step_preprocessing()
-            model.dlraBlock3.s_step_preprocessing()
-
-            model.toggle_s_step_training()
-
-            # 3.b) Tape Gradients
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=2, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            # 3.c) Apply Gradients
-            grads_s = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_s, model.trainable_weights)
-            optimizer.apply_gradients(zip(grads_s, model.trainable_weights))  # All gradients except K and L matrix
+            # K-, L- and S-Step of the integrator with rank adaption
+            if timer is None:
+                loss, out = model.train_step(batch_train[0], batch_train[1], optimizer)
+            else:
+                loss, out = model.profiled_train_step(batch_train[0], batch_train[1], optimizer, timer)
 
-            # Rank Adaptivity
-            model.dlraBlockInput.rank_adaption()
-            model.dlraBlock1.rank_adaption()
-            model.dlraBlock2.rank_adaption()
-            model.dlraBlock3.rank_adaption()
-
-            # Network monotoring and verbosity
-            loss_metric.update_state(loss)
-            prediction = tf.math.argmax(out, 1)
-            acc_metric.update_state(prediction, batch_train[1])
-
-            loss_value = loss_metric.result().numpy()
-            acc_value = acc_metric.result().numpy()
+            # Network monotoring and verbosity, the metrics accumulate over the epoch and are only read here
             if step % 100 == 0:
+                loss_value, acc_value = model.train_metrics()
                 print("step %d: mean loss S-Step = %.4f" % (step, loss_value))
                 print("Accuracy: " + str(acc_value))
-                print("Current Rank: " + str(int(model.dlraBlockInput.low_rank)) + " | " + str(
-                    int(model.dlraBlock1.low_rank)) + " | " + str(
-                    int(model.dlraBlock2.low_rank)) + " | " + str(int(model.dlraBlock3.low_rank)) + " )")
+                print("Current Rank: " + " | ".join(str(r) for r in model.ranks()) + " )")
 
-            # Reset metrics
-            loss_metric.reset_state()
-            acc_metric.reset_state()
+        if profile == 2 and epoch == 0:
+            tf.profiler.experimental.stop()
+        if adapt_every == 0:
+            # rank adaption once per epoch, in the first step of the next epoch
+            model.schedule_rank_adaption()
 
-        # Compute vallidation loss and accuracy
-        loss_val = 0
-        acc_val = 0
-
-        #  K  Step Preproccessing
-        model.dlraBlockInput.k_step_preprocessing()
-        model.dlraBlock1.k_step_preprocessing()
-        model.dlraBlock2.k_step_preprocessing()
-        model.dlraBlock3.k_step_preprocessing()
+        # aggregates of the whole epoch
+        loss_value, acc_value = model.train_metrics()
 
+        # Compute vallidation loss and accuracy
         # Validate model
-        out = model(x_val, step=0, training=False)
-        out = tf.keras.activations.softmax(out)
-        loss = loss_fn(y_val, out)
-        loss_metric.update_state(loss)
-        loss_val = loss_metric.result().numpy()
-
-        prediction = tf.math.argmax(out, 1)
-        acc_metric.update_state(prediction, y_val)
-        acc_val = acc_metric.result().numpy()
+        loss_val, acc_val = model.evaluate(val_dataset)
         print("Val Accuracy: " + str(acc_val))
 
         # save current model if it's the best
@@ -208,48 +122,30 @@ def train(start_rank, tolerance, load_model, dim_layer):
             best_loss = loss_val
             print("new best model with accuracy: " + str(best_acc) + " and loss " + str(best_loss))
 
-            model.save(folder_name=folder_name_best)
-        model.save(folder_name=folder_name)
-
-        # Reset metrics
-        loss_metric.reset_state()
-        acc_metric.reset_state()
+            model.save(folder_name=folder_name_best, compact=True, writer=checkpoint_writer)
+        model.save(folder_name=folder_name, compact=True, writer=checkpoint_writer)
 
         # Test model
-        out = model(x_test, step=0, training=False)
-        out = tf.keras.activations.softmax(out)
-        loss = loss_fn(y_test, out)
-        loss_metric.update_state(loss)
-        loss_test = loss_metric.result().numpy()
-
-        prediction = tf.math.argmax(out, 1)
-        acc_metric.update_state(prediction, y_test)
-        acc_test = acc_metric.result().numpy()
+        loss_test, acc_test = model.evaluate(test_dataset)
         log_string = "Loss: " + str(loss_test) + "| Accuracy" + str(acc_test) + "\n"
         print("Test :" + log_string)
-        # Reset metrics
-        loss_metric.reset_state()
-        acc_metric.reset_state()
 
         # Log Data of current epoch
         log_string = str(loss_value) + ";" + str(acc_value) + ";" + str(
             loss_val) + ";" + str(acc_val) + ";" + str(
-            loss_test) + ";" + str(acc_test) + ";" + str(
-            int(model.dlraBlockInput.low_rank)) + ";" + str(
-            int(model.dlraBlock1.low_rank)) + ";" + str(int(model.dlraBlock2.low_rank)) + ";" + str(
-            int(model.dlraBlock3.low_rank)) + "\n"
+            loss_test) + ";" + str(acc_test) + ";" + ";".join(str(r) for r in model.ranks()) + "\n"
         with open(file_name, "a") as log:
             log.write(log_string)
         print("Epoch Data :" + log_string)
+        if timer is not None:
+            # mean time and flops per step of each phase, next to the log file
+            timer.write_csv(profile_file_name(file_name), epoch, model.flops(batch_size, adapt=adapt_every == 1))
+            timer.reset()
 
+    checkpoint_writer.close()
     return 0
 
 
-def normalize_img(image, label):
-    """Normalizes images: `uint8` -> `float32`."""
-    return tf.cast(image, tf.float32) / 255., label
-
-
 if __name__ == '__main__':
     print("---------- Start Network Training Suite ------------")
     print("Parsing options")
@@ -260,6 +156,13 @@ if __name__ == '__main__':
     parser.add_option("-l", "--load_model", dest="load_model", default=1)
     parser.add_option("-a", "--train", dest="train", default=0)
     parser.add_option("-d", "--dim_layer", dest="dim_layer", default=200)
+    parser.add_option("-n", "--adapt_every", dest="adapt_every", default=1)  # 0: once per epoch
+    parser.add_option("-g", "--adapt_trigger", dest="adapt_trigger", default=None)  # relative singular value drift
+    parser.add_option("-p", "--precision", dest="precision", default="float32")  # or mixed_bfloat16, mixed_float16
+    parser.add_option("-f", "--profile", dest="profile", default=0)  # 1: time the phases, 2: and trace them
+    parser.add_option("-b", "--rank_budget", dest="rank_budget", default=None)  # for all layers, instead of tolerance
+    parser.add_option("-u", "--budget_unit", dest="budget_unit", default="rank")  # or flops (per sample)
+    parser.add_option("-e", "--seed", dest="seed", default=None)  # reproducible runs
 
     (options, args) = parser.parse_args()
     options.start_rank = int(options.start_rank)
@@ -267,7 +170,17 @@ if __name__ == '__main__':
     options.load_model = int(options.load_model)
     options.train = int(options.train)
     options.dim_layer = int(options.dim_layer)
+    options.profile = int(options.profile)
+    options.adapt_every = int(options.adapt_every)
+    if options.rank_budget is not None:
+        options.rank_budget = int(options.rank_budget)
+    if options.adapt_trigger is not None:
+        options.adapt_trigger = float(options.adapt_trigger)
+    if options.seed is not None:
+        options.seed = int(options.seed)
 
     if options.train == 1:
         train(start_rank=options.start_rank, tolerance=options.tolerance, load_model=options.load_model,
-              dim_layer=options.dim_layer)
+              dim_layer=options.dim_layer, adapt_every=options.adapt_every, precision=options.precision,
+              profile=options.profile, rank_budget=options.rank_budget, budget_unit=options.budget_unit,
+              adapt_trigger=options.adapt_trigger, seed=options.seed)
@@ -1,14 +1,15 @@
 from dlranet import ReferenceNet, create_csv_logger_cb
+from checkpoint import CheckpointWriter
+from dataset import mnist_datasets
 
 import tensorflow as tf
 from tensorflow import keras
 
-import numpy as np
 from optparse import OptionParser
 from os import path, makedirs
 
 
-def train(load_model=1):
+def train(load_model=1, seed=None):
     # specify training
     epochs = 250
     batch_size = 256
@@ -29,6 +30,8 @@ def train(load_model=1):
     output_dim = 10  # one-hot vector of digits 0-9
 
     dlra_layer_dim = 784
+    if seed is not None:
+        tf.keras.utils.set_random_seed(seed)
     model = ReferenceNet(input_dim=input_dim, output_dim=output_dim, layer_dim=dlra_layer_dim)
 
     # Build optimizer
@@ -37,27 +40,12 @@ def train(load_model=1):
     loss_fn = keras.losses.SparseCategoricalCrossentropy(from_logits=False)
     # Choose metrics (to monitor training, but not to optimize on)
     loss_metric = tf.keras.metrics.Mean()
-    acc_metric = tf.keras.metrics.Accuracy()
+    acc_metric = tf.keras.metrics.SparseCategoricalAccuracy()
 
-    # Build dataset
-    (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-    x_train = np.reshape(x_train, (-1, input_dim))
-    x_test = np.reshape(x_test, (-1, input_dim))
-
-    # Reserve 10,000 samples for validation.
-    val_size = 10000
-    x_val = x_train[-val_size:]
-    y_val = y_train[-val_size:]
-    (x_val, y_val) = normalize_img(x_val, y_val)
-
-    x_train = x_train[:-val_size]
-    y_train = y_train[:-val_size]
-    (x_train, y_train) = normalize_img(x_train, y_train)
-
-    (x_test, y_test) = normalize_img(x_test, y_test)
-    # Prepare the training dataset.
-    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    train_dataset = train_dataset.shuffle(buffer_size=1024).batch(batch_size)
+    # Build dataset, the training batches are shuffled, normalized and prefetched by the input pipeline. With a seed,
+    # the weights and the order of the batches are the same in every run
+    train_dataset, val_dataset, test_dataset = mnist_datasets(batch_size=batch_size, seed=seed,
+                                                              deterministic=seed is not None)
 
     # Create logger
     log_file, file_name = create_csv_logger_cb(folder_name=filename)
@@ -71,11 +59,15 @@ def train(load_model=1):
     if load_model == 1:
         model.load(folder_name=folder_name)
 
+    # checkpoints are written in the background, keeping the last 3 of each folder
+    checkpoint_writer = CheckpointWriter(keep_last=3)
     best_acc = 0
     best_loss = 10
     # Iterate over epochs. (Training loop)
     for epoch in range(epochs):
         print("Start of epoch %d" % (epoch,))
+        loss_metric.reset_state()
+        acc_metric.reset_state()
         # Iterate over the batches of the dataset.
 
         for step, batch_train in enumerate(train_dataset):
@@ -92,33 +84,23 @@ def train(load_model=1):
             # Gradient update for K and L
             optimizer.apply_gradients(zip(grads, model.trainable_weights))
 
-            # Network monotoring and verbosity
-            loss_metric.update_state(loss)
-            prediction = tf.math.argmax(out, 1)
-            acc_metric.update_state(prediction, batch_train[1])
-
-            loss_value = loss_metric.result().numpy()
-            acc_value = acc_metric.result().numpy()
+            # Network monotoring and verbosity, the metrics accumulate over the epoch and are only read here
+            loss_metric.update_state(loss, sample_weight=tf.shape(batch_train[1])[0])
+            acc_metric.update_state(batch_train[1], out)
             if step % 100 == 0:
+                loss_value = float(loss_metric.result())
+                acc_value = float(acc_metric.result())
                 print("step %d: mean loss = %.4f" % (step, loss_value))
                 print("Accuracy: " + str(acc_value))
 
-            # Reset metrics
-            loss_metric.reset_state()
-            acc_metric.reset_state()
+        # aggregates of the whole epoch
+        loss_value = float(loss_metric.result())
+        acc_value = float(acc_metric.result())
 
         # Compute vallidation loss and accuracy
 
         # Validate model
-        out = model(x_val, training=False)
-        out = tf.keras.activations.softmax(out)
-        loss = loss_fn(y_val, out)
-        loss_metric.update_state(loss)
-        loss_val = loss_metric.result().numpy()
-
-        prediction = tf.math.argmax(out, 1)
-        acc_metric.update_state(prediction, y_val)
-        acc_val = acc_metric.result().numpy()
+        loss_val, acc_val = model.evaluate(val_dataset)
         print("Val Accuracy: " + str(acc_val))
 
         # save current model if it's the best
@@ -127,28 +109,13 @@ def train(load_model=1):
             best_loss = loss_val
             print("new best model with accuracy: " + str(best_acc) + " and loss " + str(best_loss))
 
-        model.save(folder_name=folder_name_best)
-        model.save(folder_name=folder_name)
-
-        # Reset metrics
-        loss_metric.reset_state()
-        acc_metric.reset_state()
+        model.save(folder_name=folder_name_best, writer=checkpoint_writer)
+        model.save(folder_name=folder_name, writer=checkpoint_writer)
 
         # Test model
-        out = model(x_test, training=False)
-        out = tf.keras.activations.softmax(out)
-        loss = loss_fn(y_test, out)
-        loss_metric.update_state(loss)
-        loss_test = loss_metric.result().numpy()
-
-        prediction = tf.math.argmax(out, 1)
-        acc_metric.update_state(prediction, y_test)
-        acc_test = acc_metric.result().numpy()
+        loss_test, acc_test = model.evaluate(test_dataset)
         log_string = "Loss: " + str(loss_test) + "| Accuracy" + str(acc_test) + "\n"
         print("Test :" + log_string)
-        # Reset metrics
-        loss_metric.reset_state()
-        acc_metric.reset_state()
 
         # Log Data of current epoch
         log_string = str(loss_value) + ";" + str(acc_value) + ";" + str(
@@ -161,14 +128,10 @@ def train(load_model=1):
             log.write(log_string)
         print("Epoch Data :" + log_string)
 
+    checkpoint_writer.close()
     return 0
 
 
-def normalize_img(image, label):
-    """Normalizes images: `uint8` -> `float32`."""
-    return tf.cast(image, tf.float32) / 255., label
-
-
 if __name__ == '__main__':
     print("---------- Start Network Training Suite ------------")
     print("Parsing options")
@@ -176,8 +139,11 @@ if __name__ == '__main__':
     parser = OptionParser()
 
     parser.add_option("-l", "--load_model", dest="load_model", default=1)
+    parser.add_option("-e", "--seed", dest="seed", default=None)  # reproducible runs
 
     (options, args) = parser.parse_args()
     options.load_model = int(options.load_model)
+    if options.seed is not None:
+        options.seed = int(options.seed)
 
-    train(load_model=options.load_model)
+    train(load_model=options.load_model, seed=options.seed)
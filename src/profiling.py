@@ -0,0 +1,103 @@
+import time
+from contextlib import contextmanager, nullcontext
+from os import path
+import tensorflow as tf
+
+# phases of one training step, in the order of the integrator
+PHASES = ("kl_preprocessing", "kl_tape", "kl_apply", "qr_postprocessing", "s_preprocessing", "s_tape", "s_apply",
+          "rank_adaption")
+
+
+class PhaseTimer:
+    '''
+    accumulates the wall clock time of each phase of the training steps. A phase hands back the tensors (or
+    variables) it produced and only ends once the device computed them, see wait_for, so the steps that are timed run
+    slower than the compiled train_step and are meant for profiling runs.
+    With trace=True, every phase is also annotated in a tf.profiler trace (if a profiler session is running, see
+    tf.profiler.experimental.start).
+    '''
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.times = {name: 0.0 for name in PHASES}
+        self.steps = 0
+
+    @contextmanager
+    def phase(self, name: str):
+        '''
+        times the body of the with statement, e.g. with timer.phase("s_apply") as outputs: outputs.append(...)
+        :return: list, to which the phase appends the tensors or variables it computes or updates
+        '''
+        annotation = tf.profiler.experimental.Trace(name, step_num=self.steps, _r=1) if self.trace else nullcontext()
+        with annotation:
+            start = time.perf_counter()
+            outputs = []
+            yield outputs
+            wait_for(outputs)
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+    def count_step(self):
+        self.steps += 1
+        return 0
+
+    def reset(self):
+        self.times = {name: 0.0 for name in PHASES}
+        self.steps = 0
+        return 0
+
+    def summary(self):
+        '''
+        :return: dict phase -> mean time per step in seconds
+        '''
+        return {name: value / max(self.steps, 1) for name, value in self.times.items()}
+
+    def write_csv(self, file_name: str, epoch: int, flops=None):
+        '''
+        appends the summary of the timed steps as one row: epoch, steps, mean time per step of each phase and the
+        flops of each phase per step, e.g. from DLRANet.flops
+        :param file_name: csv file, the header is written if it does not exist yet
+        :param flops: dict phase -> flops per step
+        '''
+        flops = flops or {}
+        summary = self.summary()
+        if not path.isfile(file_name):
+            with open(file_name, "a") as log:
+                log.write("epoch;steps;" + ";".join("time_" + name for name in summary) + ";" + ";".join(
+                    "flops_" + name for name in summary) + "\n")
+        with open(file_name, "a") as log:
+            log.write(str(epoch) + ";" + str(self.steps) + ";" + ";".join(
+                str(value) for value in summary.values()) + ";" + ";".join(
+                str(flops.get(name, 0)) for name in summary) + "\n")
+        return 0
+
+
+def phase(timer, name: str):
+    '''
+    :param timer: PhaseTimer or None
+    :return: context that times the phase name with timer, or does nothing if timer is None. Both hand back a list
+             for the outputs of the phase.
+    '''
+    if timer is None:
+        return nullcontext([])
+    return timer.phase(name)
+
+
+def wait_for(outputs):
+    '''
+    blocks until the device computed the outputs. Eager ops run asynchronously and in order, so reading one element
+    of the last output back to the host waits for it and for all work queued before it. The times of the phases
+    include this round trip to the host.
+    :param outputs: list of tensors, variables or nested lists of them
+    '''
+    outputs = [output for output in tf.nest.flatten(outputs) if output is not None]
+    if outputs:
+        tf.reshape(outputs[-1], [-1])[:1].numpy()
+    return 0
+
+
+def profile_file_name(log_file_name: str):
+    '''
+    :param log_file_name: csv file of create_csv_logger_cb
+    :return: file name for the per epoch profile next to it
+    '''
+    return log_file_name[:-len(".csv")] + "profile.csv"